@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+#
+# benchmark - pwn-gpsd throughput and latency
+#
+# Runs pwn-gpsd.py against gpsreplay.py and attaches synthetic WATCH
+# clients that ask for every TPV. For each client count and TPV rate it
+# reports messages/s delivered, proxy CPU per message, upstream-to-client
+# latency (from the full precision send time the replay adds to each TPV), proxy
+# memory growth and the largest queue backlog ?STATS showed. Results are
+# JSON, so one release can be compared with the next:
+#
+#   benchmark.py --clients 1,10,100,1000 --rates 1,10,50 --duration 10 -o bench.json
+#
+# Needs Linux /proc for CPU and memory numbers. The clients all run in this
+# process, so at high client counts and rates it can be the bottleneck:
+# compare "lost" and the latency tail with the load generator's own CPU.
+#
+
+import logging
+import asyncio
+import getopt
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import shutil
+import time
+import re
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+WATCH = {"enable": True, "json": True, "min_period": 0, "min_distance": 0, "min_alt": 0, "sky_period": 3600}
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def write_capture(fname, rate, duration, warmup):
+    """A pwn-gpsd --capture file with TPVs at rate Hz, after warmup seconds of just SKY"""
+    t0 = time.time()
+    n = int(rate * duration)
+    with open(fname, "w") as f:
+        sky = {"class": "SKY", "device": "/dev/bench", "nSat": 8, "uSat": 6,
+               "satellites": [{"PRN": prn, "el": 30, "az": 40 * prn, "ss": 30, "used": prn <= 6} for prn in range(1, 9)]}
+        for t in range(int(warmup) + 1):
+            f.write("%.3f %s\n" % (t0 + t, json.dumps(sky)))
+        for i in range(n):
+            t = t0 + warmup + i / rate
+            tpv = {"class": "TPV", "device": "/dev/bench", "mode": 3, "time": "2000-01-01T00:00:00.000Z",
+                   "lat": 37.0 + i * 0.0001, "lon": -122.0, "alt": 10.0 + i % 100, "speed": 5.0, "eph": 3.0}
+            f.write("%.3f %s\n" % (t, json.dumps(tpv)))
+    return n
+
+def proc_cpu(pid):
+    """User + system CPU seconds of a process"""
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except Exception as e:
+        return None
+
+def proc_rss_kb(pid):
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except Exception as e:
+        pass
+    return None
+
+def percentile(values, q):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class Receiver:
+    """Time from the replay sending a TPV to its arrival, for every TPV every client gets"""
+
+    SENT = re.compile(rb'"sent":\s*([0-9.eE+-]+)')
+
+    def __init__(self):
+        self.latencies = []
+        self.messages = 0
+
+    def tpv_time(self, line):
+        """The "sent" time gpsreplay.py --stamp added. The TPV time only has milliseconds"""
+        m = self.SENT.search(line)
+        return float(m.group(1)) if m else None
+
+    async def client(self, port, since, stop):
+        (reader, writer) = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(("?WATCH=%s;\n" % json.dumps(WATCH)).encode())
+        await writer.drain()
+        try:
+            while not stop.is_set():
+                line = await reader.readline()
+                if not line:
+                    break
+                if b'"TPV"' not in line or b'"mode": 3' not in line:
+                    # the proxy repeats the last TPV with mode 1 when the replay ends
+                    continue
+                now = time.time()
+                sent = self.tpv_time(line)
+                if sent is None or sent < since:
+                    # preloaded or from before this run
+                    continue
+                self.messages += 1
+                self.latencies.append(now - sent)
+        finally:
+            writer.close()
+
+async def query_stats(port):
+    (reader, writer) = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"?STATS;\n")
+    await writer.drain()
+    try:
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            if not line:
+                return None
+            if b'"STATS"' in line:
+                return json.loads(line)
+    finally:
+        writer.close()
+
+async def wait_port(port, timeout=10):
+    end = time.time() + timeout
+    while time.time() < end:
+        try:
+            (reader, writer) = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return True
+        except OSError:
+            await asyncio.sleep(0.1)
+    return False
+
+async def run_one(n_clients, rate, duration, extra_args):
+    warmup = 2 + n_clients / 500
+    upstream_port = free_port()
+    proxy_port = free_port()
+    (fd, capture) = tempfile.mkstemp(prefix="pwn-bench-", suffix=".txt")
+    os.close(fd)
+    # the synthetic fixes must not end up in the real track logs or current.txt
+    track_dir = tempfile.mkdtemp(prefix="pwn-bench-tracks-")
+    expected = write_capture(capture, rate, duration, warmup)
+
+    procs = []
+    try:
+        procs.append(subprocess.Popen([sys.executable, os.path.join(HERE, "gpsreplay.py"), "-p", str(upstream_port),
+                                       "--once", "--retime", "--stamp", "--max-gap", "3600", capture],
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        await wait_port(upstream_port)
+        # the replay starts when the proxy connects: warmup covers connecting the clients
+        proxy = subprocess.Popen([sys.executable, os.path.join(HERE, "pwn-gpsd.py"), "-s", "127.0.0.1:%d" % upstream_port,
+                                  "-p", str(proxy_port), "--stats-interval", "0", "-Q", "1024",
+                                  "--track-dir", track_dir] + extra_args,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        procs.append(proxy)
+        if not await wait_port(proxy_port):
+            raise RuntimeError("pwn-gpsd did not start")
+
+        rx = Receiver()
+        stop = asyncio.Event()
+        since = time.time()
+        clients = [asyncio.create_task(rx.client(proxy_port, since, stop)) for i in range(n_clients)]
+        await asyncio.sleep(0.5)
+        cpu_start = proc_cpu(proxy.pid)
+        rss_start = proc_rss_kb(proxy.pid)
+        t_start = time.time()
+
+        backlog_bytes = backlog_msgs = 0
+        end = since + warmup + duration + 1
+        while time.time() < end:
+            await asyncio.sleep(1)
+            try:
+                stats = await query_stats(proxy_port)
+            except Exception as e:
+                continue
+            if stats:
+                stats['clients'] = [cl for cl in stats['clients'] if cl['watch']]
+                backlog_bytes = max(backlog_bytes, sum(cl['queued_bytes'] for cl in stats['clients']))
+                backlog_msgs = max(backlog_msgs, max((cl['queued'] for cl in stats['clients']), default=0))
+
+        elapsed = time.time() - t_start
+        cpu_end = proc_cpu(proxy.pid)
+        rss_end = proc_rss_kb(proxy.pid)
+        try:
+            stats = await query_stats(proxy_port)
+        except Exception as e:
+            logging.warning("?STATS failed: %r", e)
+            stats = None
+        stop.set()
+        for c in clients:
+            c.cancel()
+        await asyncio.gather(*clients, return_exceptions=True)
+    finally:
+        for p in procs:
+            p.send_signal(signal.SIGTERM)
+        for p in procs:
+            try:
+                p.wait(10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+        os.unlink(capture)
+        shutil.rmtree(track_dir, ignore_errors=True)
+
+    lat = sorted(rx.latencies)
+    cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {'clients': n_clients, 'rate_hz': rate, 'duration': duration,
+            'upstream_tpv': expected,
+            'expected': expected * n_clients,
+            'messages': rx.messages,
+            'lost': expected * n_clients - rx.messages,
+            'messages_per_sec': round(rx.messages / duration, 1),
+            'latency_ms': {'p50': ms(percentile(lat, 0.5)), 'p99': ms(percentile(lat, 0.99)), 'max': ms(lat[-1] if lat else None)},
+            'proxy_cpu_s': round(cpu, 3) if cpu is not None else None,
+            'proxy_cpu_us_per_message': round(cpu * 1e6 / rx.messages, 2) if cpu is not None and rx.messages else None,
+            'proxy_cpu_pct': round(100 * cpu / elapsed, 1) if cpu is not None else None,
+            'proxy_rss_kb': {'start': rss_start, 'end': rss_end,
+                             'growth': rss_end - rss_start if rss_start and rss_end else None},
+            'backlog': {'max_queued_bytes': backlog_bytes, 'max_queued_messages': backlog_msgs},
+            'proxy_stats': {k: stats[k] for k in ('tpv', 'handle_ms', 'loop_lag_ms', 'evictions')} if stats else None}
+
+def raise_nofile_limit():
+    try:
+        import resource
+        (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except Exception as e:
+        logging.warning("Could not raise open file limit: %s", e)
+
+async def main(client_counts, rates, duration, extra_args):
+    runs = []
+    for n in client_counts:
+        for rate in rates:
+            logging.info("%d clients at %s Hz for %ss", n, rate, duration)
+            try:
+                result = await run_one(n, rate, duration, extra_args)
+            except Exception as e:
+                logging.error("%d clients at %s Hz: %s", n, rate, e)
+                result = {'clients': n, 'rate_hz': rate, 'duration': duration, 'error': str(e)}
+            logging.info("  %s msg/s, lost %s, latency p50 %s p99 %s ms, %s us CPU/msg, backlog %s bytes",
+                         result.get('messages_per_sec'), result.get('lost'),
+                         (result.get('latency_ms') or {}).get('p50'), (result.get('latency_ms') or {}).get('p99'),
+                         result.get('proxy_cpu_us_per_message'), (result.get('backlog') or {}).get('max_queued_bytes'))
+            runs.append(result)
+    return runs
+
+def usage():
+    print("benchmark.py [--clients 1,10,100,1000] [--rates 1,10,50] [--duration SECS] [-o FILE] [-- pwn-gpsd options]\n")
+    print("\t--clients = WATCH client counts to try, default 1,10,100,1000\n")
+    print("\t--rates = TPV rates in Hz to try, default 1,10,50\n")
+    print("\t--duration SECS = TPV stream length for each run, default 10\n")
+    print("\t-o FILE = write the JSON results to FILE instead of stdout\n")
+    print("\tAnything after -- is passed to pwn-gpsd.py\n")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(message)s", stream=sys.stderr)
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "o:", ["clients=", "rates=", "duration=", "output=", "help"])
+    except getopt.GetoptError as err:
+        logging.error(err)
+        usage()
+        sys.exit(2)
+
+    client_counts = [1, 10, 100, 1000]
+    rates = [1, 10, 50]
+    duration = 10
+    output = None
+    for o, a in opts:
+        if o == "--clients":
+            client_counts = [int(n) for n in a.split(",")]
+        elif o == "--rates":
+            rates = [float(r) for r in a.split(",")]
+        elif o == "--duration":
+            duration = float(a)
+        elif o in ("-o", "--output"):
+            output = a
+        elif o == "--help":
+            usage()
+            sys.exit(0)
+
+    raise_nofile_limit()
+    runs = asyncio.run(main(client_counts, rates, duration, args))
+    result = {'started': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+              'host': platform.node(), 'machine': platform.machine(), 'python': platform.python_version(),
+              'args': sys.argv[1:], 'runs': runs}
+    if output:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+        logging.info("Results in %s", output)
+    else:
+        print(json.dumps(result, indent=2))
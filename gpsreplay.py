@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+#
+# gpsreplay - a stand-in gpsd that plays back recorded tracks
+#
+# Testing pwn-gpsd without a receiver: this listens like gpsd, answers
+# ?WATCH with VERSION/DEVICES/WATCH, then streams the recorded lines at the
+# pace they were recorded, or N times faster. Each client gets its own
+# playback from the start, so runs are reproducible.
+#
+# Sources, mixed freely and played in the order given:
+#   pwntrack_*.txt   text track logs, TPV only. A SKY is made up to go with them
+#   pwntrack_*.bin   binary track logs (pwntrack.py)
+#   capture files    raw gpsd lines recorded with pwn-gpsd.py --capture FILE,
+#                    played back as they came, NMEA included
+#
+#   gpsreplay.py --port 2947 --speed 10 /etc/pwnagotchi/pwn_gpsd/pwntrack_20240101.txt
+#   pwn-gpsd.py -s 127.0.0.1:2947 -p 7492 --track-dir /tmp/replay-tracks
+#
+# The proxy logs whatever it is fed, so give it a scratch --track-dir, or
+# the replayed positions end up in the real track logs and current.txt.
+#
+
+import logging
+import asyncio
+import getopt
+import json
+import os
+import re
+import sys
+import time
+
+import pwntrack
+
+DEVICE = "/dev/gpsreplay"
+VERSION = {"class": "VERSION", "release": "3.25", "rev": "gpsreplay", "proto_major": 3, "proto_minor": 15}
+
+CAPTURE_LINE = re.compile(rb"^(\d+\.\d+) (.*\n?)$", re.S)
+# sent by the replay itself, so not played back from captures
+HANDSHAKE = re.compile(rb'"class"\s*:\s*"(VERSION|DEVICES|WATCH)"')
+
+def make_sky(tpv):
+    """A SKY report to go with a track TPV, which did not record one"""
+    used = {3: 8, 2: 4}.get(tpv.get('mode', 0), 0)
+    return {"class": "SKY", "device": tpv.get('device', DEVICE), "time": tpv.get('time'),
+            "nSat": 10, "uSat": used,
+            "satellites": [{"PRN": prn, "el": 10 + 7 * prn, "az": 36 * prn, "ss": 30, "used": prn <= used}
+                           for prn in range(1, 11)]}
+
+def iter_track(fname, sky_period=1):
+    """(time, line) from a text or binary track log"""
+    if pwntrack.is_binary(fname):
+        tpvs = (pwntrack.record_to_tpv(rec) for rec in pwntrack.iter_records(fname))
+    else:
+        tpvs = pwntrack.iter_text(fname)
+    last_sky = None
+    for tpv in tpvs:
+        if not isinstance(tpv, dict) or tpv.get('class', 'TPV') != 'TPV':
+            continue
+        t = pwntrack.parse_time(tpv.get('time'))
+        tpv['class'] = 'TPV'
+        tpv.setdefault('device', DEVICE)
+        yield (t, tpv)
+        if sky_period and (last_sky is None or t - last_sky >= sky_period):
+            last_sky = t
+            yield (t, make_sky(tpv))
+
+def iter_capture(fname):
+    """(time, line) from a pwn-gpsd --capture file"""
+    with open(fname, "rb") as f:
+        for line in f:
+            m = CAPTURE_LINE.match(line)
+            if not m:
+                logging.debug("skip line %s: %s", os.path.basename(fname), line[:40])
+                continue
+            if HANDSHAKE.search(m.group(2)[:40]):
+                continue
+            yield (float(m.group(1)), m.group(2))
+
+def is_capture(fname):
+    with open(fname, "rb") as f:
+        return CAPTURE_LINE.match(f.readline()) is not None
+
+class Replay:
+    """Plays the sources to each client that sends ?WATCH"""
+
+    def __init__(self, files, speed=1.0, max_gap=10, sky_period=1, loop=False, retime=False, once=False, stamp=False):
+        self.files = files
+        self.speed = speed            # 2 plays twice as fast, 0 as fast as possible
+        self.max_gap = max_gap        # longest pause between lines, in recorded seconds
+        self.sky_period = sky_period  # recorded seconds between made up SKY reports for tracks
+        self.loop = loop              # start over at the end
+        self.retime = retime          # stamp TPVs with the time they are sent
+        self.stamp = stamp            # add "sent", the unix time at full precision, to each TPV
+        self.once = once              # exit after the first playback
+        self.done = asyncio.Event()
+
+    def lines(self):
+        """(time, bytes or dict) from every source in order"""
+        for fname in self.files:
+            if not pwntrack.is_binary(fname) and is_capture(fname):
+                yield from iter_capture(fname)
+            else:
+                yield from iter_track(fname, self.sky_period)
+
+    def encode(self, obj, nmea):
+        if isinstance(obj, bytes):
+            if obj[:1] in (b"$", b"!"):
+                return obj if nmea else None
+            if (self.retime or self.stamp) and b'"class":"TPV"' in obj.replace(b" ", b""):
+                obj = json.loads(obj)
+            else:
+                return obj if obj.endswith(b"\n") else obj + b"\n"
+        now = time.time()
+        if self.retime and obj.get('time'):
+            obj['time'] = pwntrack.format_time(now)
+        if self.stamp and obj.get('class') == 'TPV':
+            obj['sent'] = now
+        return (json.dumps(obj) + "\n").encode()
+
+    async def play(self, writer, nmea):
+        loop = asyncio.get_running_loop()
+        n = 0
+        while True:
+            start = loop.time()
+            offset = None      # recorded time that plays at start
+            prev = None
+            for (t, obj) in self.lines():
+                if offset is None:
+                    offset = t
+                elif t - prev > self.max_gap:
+                    # skip long stretches with nothing recorded
+                    offset += t - prev - self.max_gap
+                prev = t
+                if self.speed:
+                    delay = (t - offset) / self.speed - (loop.time() - start)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                line = self.encode(obj, nmea)
+                if line:
+                    writer.write(line)
+                    n += 1
+                    await writer.drain()
+            if not self.loop:
+                return n
+
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        logging.info("Client %s connected", peer)
+        writer.write((json.dumps(VERSION) + "\n").encode())
+        playing = None
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                cmd = line.decode(errors="replace").strip()
+                if cmd.startswith("?WATCH"):
+                    try:
+                        watch = json.loads(cmd.split("=", 1)[1].rstrip(";")) if "=" in cmd else {"enable": True}
+                    except Exception as e:
+                        watch = {"enable": True}
+                    watch = dict({"class": "WATCH", "enable": True, "json": True}, **watch)
+                    writer.write((json.dumps({"class": "DEVICES", "devices": [{"class": "DEVICE", "path": DEVICE,
+                                                                                "driver": "gpsreplay"}]}) + "\n").encode())
+                    writer.write((json.dumps(watch) + "\n").encode())
+                    if watch.get("enable") and not playing:
+                        playing = asyncio.create_task(self.play(writer, watch.get("nmea", False)))
+                        playing.add_done_callback(lambda t: self.finished(t, peer))
+                elif cmd.startswith("?DEVICES"):
+                    writer.write((json.dumps({"class": "DEVICES", "devices": [{"class": "DEVICE", "path": DEVICE}]}) + "\n").encode())
+                elif cmd.startswith("?VERSION"):
+                    writer.write((json.dumps(VERSION) + "\n").encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            if playing:
+                playing.cancel()
+            writer.close()
+            logging.info("Client %s disconnected", peer)
+
+    def finished(self, task, peer):
+        if task.cancelled():
+            return
+        if task.exception():
+            logging.warning("Replay to %s stopped: %s", peer, task.exception())
+        else:
+            logging.info("Replayed %d lines to %s", task.result(), peer)
+        if self.once:
+            self.done.set()
+
+async def serve(replay, host, port):
+    server = await asyncio.start_server(replay.handle, host, port)
+    logging.info("Replaying %s on %s:%d at %sx", ", ".join(replay.files), host, port, replay.speed or "max")
+    async with server:
+        await replay.done.wait()
+        # let the last lines reach the client before closing
+        await asyncio.sleep(0.5)
+
+def usage():
+    print("gpsreplay.py [--host H] [--port PORT] [--speed N] [--max-gap SECS] [--sky-period SECS] [--loop] [--retime] [--stamp] [--once] FILE...\n")
+    print("\tFILE = pwntrack text or binary track log, or a pwn-gpsd.py --capture file\n")
+    print("\tPORT = port to listen on, default 2947\n")
+    print("\t--speed N = play N times faster than recorded, 0 for as fast as possible, default 1\n")
+    print("\t--max-gap SECS = shorten pauses in the recording to at most this, default 10\n")
+    print("\t--sky-period SECS = make up a SKY report this often for track logs, 0 for none, default 1\n")
+    print("\t--loop = start over at the end\n")
+    print("\t--retime = stamp TPVs with the current time instead of the recorded one\n")
+    print("\t--stamp = add \"sent\", the unix time each TPV is sent at full precision, for latency measurements\n")
+    print("\t--once = exit when the first client has been sent everything\n")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(levelname)s] %(message)s")
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "H:p:", ["host=", "port=", "speed=", "max-gap=", "sky-period=",
+                                                         "loop", "retime", "once", "stamp", "help"])
+    except getopt.GetoptError as err:
+        logging.error(err)
+        usage()
+        sys.exit(2)
+
+    host = "127.0.0.1"
+    port = 2947
+    settings = {}
+    for o, a in opts:
+        if o in ("-H", "--host"):
+            host = a
+        elif o in ("-p", "--port"):
+            port = int(a)
+        elif o == "--speed":
+            settings['speed'] = float(a)
+        elif o == "--max-gap":
+            settings['max_gap'] = float(a)
+        elif o == "--sky-period":
+            settings['sky_period'] = float(a)
+        elif o == "--loop":
+            settings['loop'] = True
+        elif o == "--retime":
+            settings['retime'] = True
+        elif o == "--once":
+            settings['once'] = True
+        elif o == "--stamp":
+            settings['stamp'] = True
+        elif o == "--help":
+            usage()
+            sys.exit(0)
+
+    if not args:
+        usage()
+        sys.exit(2)
+    for fname in args:
+        if not os.path.isfile(fname):
+            logging.error("No such file: %s", fname)
+            sys.exit(1)
+
+    try:
+        asyncio.run(serve(Replay(args, **settings), host, port))
+    except KeyboardInterrupt:
+        pass
@@ -43,6 +43,7 @@ except Exception as e:
     logging.warning("Install orjson with pip to get better json performance")
     import json
 
+import sys
 import random
 import hashlib
 import base64
@@ -57,8 +58,28 @@ import RPi.GPIO as GPIO
 
 from PIL import Image, ImageDraw, ImageFont
 
+try:
+    # pwntrack.py lives next to this plugin
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import pwntrack
+except Exception as e:
+    logging.warning("Copy pwntrack.py next to peer_map.py to read binary track logs")
+    pwntrack = None
+
+try:
+    import pwnshare
+except Exception as e:
+    logging.warning("Copy pwnshare.py next to peer_map.py to cache decrypted peer locations")
+    pwnshare = None
+
 ADV_FIELD='snorlax'
 
+def trackExists(fname):
+    """Whether there is a log for this track, as text or as a binary log written with --track-format binary"""
+    if os.path.isfile(fname):
+        return True
+    return pwntrack is not None and os.path.isfile(pwntrack.binary_name(fname))
+
 def checkBounds(overall, new):
     if not new:
         return overall
@@ -115,7 +136,7 @@ def boxesOverlap(a, b):
                 # above or below the other
                 return False
         else:
-            logging.warn("Expected box or point: %s" % (b))
+            logging.warning("Expected box or point: %s" % (b))
         return True
     except Exception as e:
         logging.exception(e)
@@ -158,6 +179,8 @@ class gpsTrack:
                 logging.debug("Loaded %s %s" % (len(self.segments), filename))
 
     def parseTime(self, t_str):
+        if isinstance(t_str, (int, float)):
+            return int(t_str)
         if t_str:
             return int(time.mktime(time.strptime(t_str, "%Y-%m-%dT%H:%M:%S.%fZ")))
         else:
@@ -252,37 +275,57 @@ class gpsTrack:
                     logging.info("too new")
                 return False
 
-            if filename and os.path.isfile(filename):
+            # prefer the binary version of a track log, unless the text one has newer fixes
+            source = filename
+            if pwntrack and filename:
+                source = pwntrack.track_source(filename)
+
+            if source and os.path.isfile(source):
                 if self.verbose:
-                    logging.info("file %s exists" % (filename))
+                    logging.info("file %s exists" % (source))
                 self.filename = filename
-                mtime = os.stat(filename).st_mtime
+                mtime = os.stat(source).st_mtime
                 if ifUpdated == False or mtime > self.mtime:
                     if self.verbose:
-                        logging.info("loading %s" % filename)
+                        logging.info("loading %s" % source)
                     self.mtime = mtime
-                    lines = []
-                    with open(filename) as f:
-                        lines = f.readlines() #[line.rstrip().strip(',') for line in f]
                     # temporary with name as filename. not actual filename, which would be 2nd parameter
                     tmp = gpsTrack(filename, keep_going=self.keep_going)
                     tmp.segments=[]
 
-                    for line in lines:
-                        l = line.rstrip().strip(',')
-                        try:
+                    nlines = 0
+                    if source != filename or (pwntrack and pwntrack.is_binary(source)):
+                        recs = pwntrack.read_records(source)
+                        nlines = len(recs)
+                        for (t, lat, lon, alt) in zip(recs['time'].tolist(), recs['lat'].tolist(),
+                                                      recs['lon'].tolist(), recs['alt'].tolist()):
                             if not self.keep_going:
                                 break
-                            tpv = json.loads(l)
                             try:
-                                tmp.addPoint(tpv)
+                                tmp.addPoint({'time': t, 'lat': lat, 'lon': lon, 'alt': alt if alt == alt else 0})
                             except Exception as e:
                                 logging.exception(e)
-                        except Exception as e:
-                            logging.debug("- skip line: %s %s" % (os.path.basename(filename), e))
+                    else:
+                        lines = []
+                        with open(filename) as f:
+                            lines = f.readlines() #[line.rstrip().strip(',') for line in f]
+                        nlines = len(lines)
+
+                        for line in lines:
+                            l = line.rstrip().strip(',')
+                            try:
+                                if not self.keep_going:
+                                    break
+                                tpv = json.loads(l)
+                                try:
+                                    tmp.addPoint(tpv)
+                                except Exception as e:
+                                    logging.exception(e)
+                            except Exception as e:
+                                logging.debug("- skip line: %s %s" % (os.path.basename(filename), e))
                     if len(tmp.segments) > 0:
                         if self.verbose:
-                            logging.warn("Loaded %s %d lines, %d segments within %s" % (os.path.basename(filename), len(lines), len(tmp.segments), tmp.bounds))
+                            logging.warning("Loaded %s %d lines, %d segments within %s" % (os.path.basename(source), nlines, len(tmp.segments), tmp.bounds))
                     if len(tmp.segments):
                         self.bounds = tmp.bounds.copy()
                         self.segments = deepcopy(tmp.segments)
@@ -293,7 +336,7 @@ class gpsTrack:
                         logging.error("Empty track: %s" % filename)
                 return False
             else:
-                logging.warn("No track file: %s" % (filename))
+                logging.warning("No track file: %s" % (filename))
                 return False
         except Exception as e:
             logging.exception(e)
@@ -374,7 +417,7 @@ class Peer_Map(plugins.Plugin, Widget):
                         self.updateImage()
                         self.redrawImage = False
                         if time.time() - now > 10:
-                            logging.warn("Slow redraw %fs" % (time.time() - now))
+                            logging.warning("Slow redraw %fs" % (time.time() - now))
                         time.sleep(5)
                     else:
                         self.trigger_redraw.wait(timeout=2)
@@ -502,7 +545,7 @@ class Peer_Map(plugins.Plugin, Widget):
                     if 'STATES' in feats: ax.add_feature(cfeature.STATES.with_scale(fscale), zorder=3, linewidth=.1, edgecolor='DarkGrey', linestyle=':')
                         
                     if time.time() - then > 1:
-                        logging.warn("Finished features (%fs)" % (time.time()-then))
+                        logging.warning("Finished features (%fs)" % (time.time()-then))
                 except Exception as e:
                     logging.exception(e)
         else:
@@ -540,14 +583,14 @@ class Peer_Map(plugins.Plugin, Widget):
                 i += 1
                 logging.debug("Track (%fs) %d %s" % (time.time()-then, len(t.segments), f))
         if time.time() - then > 4:
-            logging.warn("Slow drew tracks (%fs) (%s %s)" % (time.time()-then, w,h))
+            logging.warning("Slow drew tracks (%fs) (%s %s)" % (time.time()-then, w,h))
 
         # draw peers
         i = 1
         stale_peers = []
         for p, info in self.peers.items():
             if now - info.get('tstamp', 0) > 300: # skip if older than 5 minutes
-                logging.warn("Skipping stale peer: %s, %s seconds old (300 lim)" % (info.get('name'), now - info.get('tstamp', 0)))
+                logging.warning("Skipping stale peer: %s, %s seconds old (300 lim)" % (info.get('name'), now - info.get('tstamp', 0)))
                 if now - info.get('tstamp', 0) > 600:
                     stale_peers.append(p)
                 continue
@@ -687,13 +730,13 @@ class Peer_Map(plugins.Plugin, Widget):
 
         self.image = image
         if time.time() - then > 10:
-            logging.warn("Updated (%fs) %s %s" % (time.time()-then,w,h))
+            logging.warning("Updated (%fs) %s %s" % (time.time()-then,w,h))
       except Exception as e:
           logging.exception(e)
       self._ui.set('peer_map', time.time())
 
       for p in stale_peers:
-          logging.warn("Deleting stale peer %s" % p)
+          logging.warning("Deleting stale peer %s" % p)
           del self.peers[p]
 
 
@@ -839,7 +882,7 @@ class Peer_Map(plugins.Plugin, Widget):
         while i < num_days*3 and n < num_days and self.keep_going:
             fname = (now - timedelta(days=i)).strftime(tracks_fname_fmt)
             logging.debug("Looking for %s" % os.path.join(self.t_dir, fname))
-            if os.path.isfile(os.path.join(self.t_dir, fname)):
+            if trackExists(os.path.join(self.t_dir, fname)):
                 t = gpsTrack(fname, os.path.join(self.t_dir, fname), True, True)
                 self.tracks[fname] = t
                 n += 1
@@ -853,7 +896,7 @@ class Peer_Map(plugins.Plugin, Widget):
         while i < 30 and n < self.options.get("days", 3) and self.keep_going:
             fname = (now - timedelta(days=i)).strftime(tracks_fname_fmt)
             logging.debug("Looking for %s" % os.path.join(self.t_dir, fname))
-            if os.path.isfile(os.path.join(self.t_dir, fname)):
+            if trackExists(os.path.join(self.t_dir, fname)):
                 t = gpsTrack(fname, os.path.join(self.t_dir, fname), True, True)
                 self.tracks[fname] = t
                 n += 1
@@ -915,7 +958,7 @@ class Peer_Map(plugins.Plugin, Widget):
                     logging.debug("Decrypted (%s): %s" % (type(decrypted_message).__name__, decrypted_message))
                     return json.loads(decrypted_message)
                 except Exception as e:
-                    logging.warn("Not JSON: %s, %s" % (e, decrypted_message))
+                    logging.warning("Not JSON: %s, %s" % (e, decrypted_message))
                     return decrypted_message
             except Exception as e2:
                 logging.error("Decrypt failed: %s" % (e2))
@@ -923,6 +966,19 @@ class Peer_Map(plugins.Plugin, Widget):
         else:
             return default
 
+    def decrypt_location(self, encrypted_message):
+        """Decrypt a peer's shared location to a TPV dict, or None"""
+        if not self.password:
+            return None
+        if pwnshare:
+            return pwnshare.location_cache((self.password,)).decrypt(encrypted_message)
+        raw = self.decrypt_data(encrypted_message)
+        try:
+            return json.loads(raw) if raw else None
+        except Exception as e:
+            logging.error("JSON.loads(%s) %s" % (raw, e))
+            return None
+
     def current_touch_status(self):
         return self.touch_info.get('status', {'pressed':False, 'last_press':None})
 
@@ -932,7 +988,7 @@ class Peer_Map(plugins.Plugin, Widget):
     def on_touch_release(self, ts, ui, ui_element, touch_data):
         logging.debug("Touch release: %s, %s" % (touch_data, ui_element));
         if ui_element != "peer_map":
-            logging.warn("Touch release but not my element")
+            logging.warning("Touch release but not my element")
             return
     
         if not self.window_size:
@@ -1032,20 +1088,16 @@ class Peer_Map(plugins.Plugin, Widget):
                 info = self.peers.get(id, {})  # stored peer data
                 if e_msg and e_msg != info.get('enc', None):  # only process if message changed
                     try:
-                        raw = self.decrypt_data(e_msg)
-                        if raw and raw != info.get('raw', ''):  # double check
-                            try:
-                                data = json.loads(raw)  # read new peer info into a dict
-                                if 'lat' in data and 'lon' in data:
-                                    logging.debug("Saving PEER %s: %s" % (p.adv.get('name', None), data))
-                                    name = p.adv.get('name', "peer")
-                                    data['name'] = name
-                                    self.peers[id] = {'enc': e_msg, 'raw': raw, 'tpv': data, 'name': name, 'tstamp':time.time() }
-                                    ret = True
-                            except Exception as e:
-                                logging.error("JSON.loads(%s) %s" % (raw, e))
-                        else:
-                            logging.warn("New encrypt, same raw")
+                        data = self.decrypt_location(e_msg)
+                        if data and 'lat' in data and 'lon' in data:
+                            name = p.adv.get('name', "peer")
+                            data['name'] = name
+                            if data != info.get('tpv', None):  # double check
+                                logging.debug("Saving PEER %s: %s" % (name, data))
+                                ret = True
+                            else:
+                                logging.debug("New encrypt, same location")
+                            self.peers[id] = {'enc': e_msg, 'tpv': data, 'name': name, 'tstamp':time.time() }
                     except Exception as e:
                         logging.exception(e)
         return ret
@@ -9,6 +9,7 @@ from pwnagotchi.mesh.peer import Peer
 import numpy
 import random
 import os
+import sys
 from datetime import datetime
 from datetime import timedelta
 import time
@@ -19,6 +20,55 @@ from urllib.parse import urlparse, unquote
 from cryptography.fernet import Fernet
 from PIL import Image, ImageDraw, ImageFont
 
+try:
+    # pwntrack.py lives next to this plugin
+    sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+    import pwntrack
+except Exception as e:
+    logging.warning("Copy pwntrack.py next to plot_gps.py to read binary track logs")
+    pwntrack = None
+
+try:
+    import pwnshare
+except Exception as e:
+    logging.warning("Copy pwnshare.py next to plot_gps.py to cache decrypted peer locations")
+    pwnshare = None
+
+TRACK_DTYPE = [('lat', 'f8'), ('lon', 'f8')]
+
+def readTrack(fname):
+    """Read a day of track as a numpy array with lat and lon fields.
+    Uses the binary log when it is up to date, the text log otherwise"""
+    if pwntrack:
+        source = pwntrack.track_source(fname)
+        if source != fname:
+            return pwntrack.read_records(source)
+        if os.path.isfile(fname):
+            return pwntrack.load_track(fname)
+        return None
+    if not os.path.isfile(fname):
+        return None
+    points = []
+    with open(fname) as f:
+        for l in f:
+            try:
+                l = l.rstrip().strip(",").strip('\0')
+                if l != "":
+                    tpv = json.loads(l)
+                    if 'lat' in tpv and 'lon' in tpv:
+                        points.append((tpv['lat'], tpv['lon']))
+            except Exception as e:
+                logging.exception("%s: %s" % (l, e))
+    return numpy.array(points, dtype=TRACK_DTYPE)
+
+def trackMTime(fname):
+    """Modification time of the newer of the text and binary logs, or 0"""
+    mtime = 0
+    for f in ([pwntrack.binary_name(fname)] if pwntrack else []) + [fname]:
+        if os.path.isfile(f):
+            mtime = max(mtime, os.stat(f).st_mtime)
+    return mtime
+
 
 class gpsImage(Widget):
     def __init__(self, position=(219,120,319,220), color='White', *, font=None, password="Friendship", tracks=[]):
@@ -50,17 +100,11 @@ class gpsImage(Widget):
         self.tracks = tracks
         if len(tracks):
             for track in self.tracks:
-                for step in track:
-                    lat = step.get('lat')
-                    lon = step.get('lon')
-                    if lat < self.track_lims[1]:
-                        self.track_lims[1] = lat
-                    if lat > self.track_lims[3]:
-                        self.track_lims[3] = lat
-                    if lon < self.track_lims[0]:
-                        self.track_lims[0] = lon
-                    if lon > self.track_lims[2]:
-                        self.track_lims[2] = lon
+                if len(track):
+                    self.track_lims[0] = min(self.track_lims[0], float(track['lon'].min()))
+                    self.track_lims[1] = min(self.track_lims[1], float(track['lat'].min()))
+                    self.track_lims[2] = max(self.track_lims[2], float(track['lon'].max()))
+                    self.track_lims[3] = max(self.track_lims[3], float(track['lat'].max()))
                 logging.info("%s steps in bbox %s" % (len(track), self.track_lims))
 
     def generate_key(self, password=None):
@@ -70,15 +114,21 @@ class gpsImage(Widget):
         ekey = hashlib.sha256(password.encode()).digest()
         return base64.urlsafe_b64encode(ekey)
 
+    def fernet(self, password=None):
+        """Fernet for a password, from pwnshare's cache. Built here only when pwnshare is missing"""
+        if not password:
+            password = self.password
+        if pwnshare:
+            return pwnshare.fernet_for(password)
+        return Fernet(self.generate_key(password))
+
     def decrypt_data(self, encrypted_message, default=None):
         """Decrypts a message with a password."""
         if encrypted_message:
-            f = Fernet(self.generate_key())
             try:
-                decrypted_message = f.decrypt(encrypted_message.encode()).decode()
+                decrypted_message = self.fernet().decrypt(encrypted_message.encode()).decode()
             except Exception as e:
-                f = Fernet(self.generate_key(password="Friendship"))
-                decrypted_message = f.decrypt(encrypted_message.encode()).decode()
+                decrypted_message = self.fernet("Friendship").decrypt(encrypted_message.encode()).decode()
                 
             try:
                 return json.loads(decrypted_message)
@@ -88,6 +138,12 @@ class gpsImage(Widget):
         else:
             return default
 
+    def decrypt_location(self, encrypted_message):
+        """Decrypt a peer's shared location to a TPV dict, trying our password then the default"""
+        if pwnshare:
+            return pwnshare.location_cache((self.password, "Friendship")).decrypt(encrypted_message)
+        return json.loads(self.decrypt_data(encrypted_message))
+
     def processPeers(self, peers):
         points = {}
         minx = self.track_lims[0]
@@ -133,9 +189,9 @@ class gpsImage(Widget):
             logging.debug("Peer: %s" % p.adv)
             adv = p.adv   # wtf
             if 'snorlax' in adv:
-                tpv = json.loads(self.decrypt_data(adv.get('snorlax', {})))
+                tpv = self.decrypt_location(adv.get('snorlax'))
                 logging.info("%s: %s" % (p.name(), tpv))
-                if 'lat' in tpv:
+                if tpv and 'lat' in tpv:
                     logging.info("%s -> %s, %s" % (p.name(), tpv.get('lat', random.randint(0,100)), tpv.get('lon', random.randint(0,100))))
                     points[p.name()] = tpv
                     x = tpv.get('lon', minx)
@@ -230,13 +286,10 @@ class gpsImage(Widget):
             logging.debug("Midpoint: %s, %s" % (mex, mey))
             # draw tracks first
             for i in range(len(self.tracks)-1, -1, -1):
-                for step in self.tracks[i]:
-                    lat = step.get('lat')
-                    lon = step.get('lon')
-                    x = (step.get('lon') - mex) * scalex + w/2
-                    y = (step.get('lat') - mey) * scaley + h/2
-                    #logging.info(" Point - %s, %s, %s, %s %s" % (step.get('lat'), step.get('lon'), x, y, self.trackColors[i%len(self.trackColors)]))
-                    dr.point((x,h-y), fill=self.trackColors[i % len(self.trackColors)])
+                track = self.tracks[i]
+                xs = (track['lon'] - mex) * scalex + w/2
+                ys = h - ((track['lat'] - mey) * scaley + h/2)
+                dr.point(list(zip(xs.tolist(), ys.tolist())), fill=self.trackColors[i % len(self.trackColors)])
 
             # then peers
             i = 0
@@ -312,19 +365,12 @@ class PlotGPS(plugins.Plugin):
 
         for i in range(self.options.get("day_tracks", 5)):
             fname = (now - timedelta(days=i)).strftime("/etc/pwnagotchi/pwn_gpsd/pwntrack_%Y%m%d.txt")
-            if os.path.isfile(fname):
-                track = []
-                with open(fname) as f:
-                    lines = [line.rstrip() for line in f]
-                for l in lines:
-                    try:
-                        l = l.strip(",")
-                        l = l.strip('\000')
-                        if l != "":
-                            tpv = json.loads(l)
-                            track.append(tpv)
-                    except Exception as e:
-                        logging.exception("%s: %s" % (l, e))
+            try:
+                track = readTrack(fname)
+            except Exception as e:
+                logging.exception("%s: %s" % (fname, e))
+                track = None
+            if track is not None:
                 logging.info("Read track %s with %s steps" % (fname, len(track)))
                 self.tracks.append(track)
 
@@ -492,51 +538,43 @@ class PlotGPS(plugins.Plugin):
                 logging.exception("[pwn-gpsd handshake] %s" % repr(err))
 
     # called when an epoch is over (where an epoch is a single loop of the main algorithm)
+    def reloadTrack(self, fname):
+        logging.info("Reloading track %s" % (fname))
+        track = readTrack(fname)
+        if track is None:
+            return
+
+        # zoom in to today
+        track_lims = [200,200,-200,-200]
+        if len(track):
+            track_lims = [float(track['lon'].min()), float(track['lat'].min()),
+                          float(track['lon'].max()), float(track['lat'].max())]
+        if len(self.tracks):
+            self.tracks[0] = track
+        else:
+            self.tracks.append(track)
+        logging.info("Read track with %s steps %s" % (len(self.tracks[0]), track_lims))
+        self.gpsImage.loadTracks(self.tracks)
+        self.gpsImage.track_lims = track_lims
+        self.gpsImage.image = None
+
     def on_epoch(self, agent, epoch, epoch_data):
       try:
         if self.gpsImage:
 
             now = datetime.now()
             fname = now.strftime("/etc/pwnagotchi/pwn_gpsd/pwntrack_%Y%m%d.txt")
-            if os.path.isfile(fname):
-                st = os.stat(fname)
-                mtime = st.st_mtime if st else 0
-
+            mtime = trackMTime(fname)
+            if mtime:
                 if mtime == self.tracks_updated:
                     logging.debug("Tracks unchanged.")
                 else:
                     self.tracks_updated = mtime
-                    
-                    logging.info("Reloading track %s" % (fname))
-                    with open(fname) as f:
-                        lines = [line.rstrip() for line in f]
-
-                    track_lims = [200,200,-200,-200]
-                    self.tracks[0] = []
-                    for l in lines:
-                        try:
-                            l = l.strip(",")
-                            l = l.strip('\0')
-                            tpv = json.loads(l)
-
-                            # zoom in to today
-                            self.tracks[0].append(tpv)
-                            lon = tpv.get('lon')
-                            lat = tpv.get('lat')
-                            if lon < track_lims[0]:
-                                track_lims[0] = lon
-                            if lon > track_lims[2]:
-                                track_lims[2] = lon
-                            if lat < track_lims[1]:
-                                track_lims[1] = lat
-                            if lat > track_lims[3]:
-                                track_lims[3] = lat
-                        except Exception as e:
-                            logging.exception("%s: %s" % (l, e))
-                    logging.info("Read track with %s steps %s" % (len(self.tracks[0]), track_lims))
-                    self.gpsImage.loadTracks(self.tracks)
-                    self.gpsImage.track_lims = track_lims
-                    self.gpsImage.image = None
+                    # a track that will not load must not stop the peers from being drawn
+                    try:
+                        self.reloadTrack(fname)
+                    except Exception as e:
+                        logging.exception("Reading track %s: %s" % (fname, e))
 
             if self.agent: 
                 self.gpsImage.processPeers(self.agent._peers)
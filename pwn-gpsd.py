@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 
 import logging
-import socket, select, time
+import asyncio
+import socket, time
 from socket import error as SocketError
 import errno
 from datetime import datetime
@@ -10,28 +11,164 @@ import os
 import sys
 import signal
 import json
+import re
 import getopt
 import random
+import math
 import copy
-
-import hashlib
-import base64
-from cryptography.fernet import Fernet
-
-
-from statistics import mean
-from urllib.request import urlopen
-import urllib
-import urllib.parse
-import urllib.request
-
-import pwnagotchi.plugins as plugins
-from pwnagotchi.ui.components import LabeledValue
-from pwnagotchi.ui.view import BLACK
-import pwnagotchi.ui.fonts as fonts
-
-from pwnagotchi.bettercap import Client as bettercap
-from pwnagotchi import grid as pwngrid
+import itertools
+import bisect
+import heapq
+import importlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+import threading
+
+try:
+    import orjson
+except Exception as e:
+    logging.warning("Install orjson with pip to get better json performance")
+    orjson = None
+
+try:
+    import pwnshare
+except Exception as e:
+    pwnshare = None
+
+# Imported on first use, so the daemon starts quickly: pwntrack (and numpy)
+# only for binary tracks, the pwngrid client only with -S or -U. The
+# plugin's pwnagotchi imports are down by the PWN_GPSD class.
+pwntrack = None
+pwngrid = None
+
+def lazy_import(name):
+    """Import a module the first time a feature needs it, None if it is not installed"""
+    try:
+        return importlib.import_module(name)
+    except Exception as e:
+        logging.warning("Could not import %s: %s", name, e)
+        return None
+
+def debug_enabled():
+    """Whether DEBUG logging is on. Hot paths check before building any log text"""
+    return logging.root.isEnabledFor(logging.DEBUG)
+
+class PWN_LogLimit:
+    """Rate limit for a noisy log site: burst messages per period, then a
+    count of how many were held back, added to the next one let through."""
+
+    sites = {}
+
+    def __init__(self, period=60, burst=5):
+        self.period = period
+        self.burst = burst
+        self.window = -period
+        self.count = 0
+        self.held = 0
+
+    def emit(self, level, msg, args):
+        now = time.monotonic()
+        held = 0
+        if now - self.window >= self.period:
+            (held, self.held) = (self.held, 0)
+            self.window = now
+            self.count = 0
+        if self.count >= self.burst:
+            self.held += 1
+            return
+        self.count += 1
+        if held:
+            msg += " (%d like this held back)"
+            args += (held,)
+        logging.log(level, msg, *args, stacklevel=3)
+
+def log_limited(site, level, msg, *args, period=60, burst=5):
+    """Log with lazy arguments, at most burst times per period for this site"""
+    if not logging.root.isEnabledFor(level):
+        return
+    limit = PWN_LogLimit.sites.get(site)
+    if limit is None:
+        limit = PWN_LogLimit.sites[site] = PWN_LogLimit(period, burst)
+    limit.emit(level, msg, args)
+
+class PWN_Trace:
+    """Ring buffer of recent message events, cheap enough to leave on.
+
+    Events are stored as tuples with references to the lines as received,
+    and only formatted when the buffer is dumped (on SIGUSR1)."""
+
+    def __init__(self, size=2000):
+        self.events = deque(maxlen=size)
+
+    def add(self, event, *detail):
+        self.events.append((time.time(), event, detail))
+
+    def dump(self):
+        out = []
+        for (t, event, detail) in list(self.events):
+            text = " ".join(d.decode(errors="replace").strip() if isinstance(d, bytes) else str(d).strip() for d in detail)
+            out.append("%s.%03d %-7s %s" % (time.strftime("%H:%M:%S", time.localtime(t)), int(t * 1000) % 1000, event, text))
+        logging.warning("Last %d events:\n%s", len(out), "\n".join(out))
+
+def process_age():
+    """Seconds since this process was started, from /proc, or None"""
+    try:
+        with open("/proc/self/stat") as f:
+            started = int(f.read().rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+        with open("/proc/uptime") as f:
+            return float(f.read().split()[0]) - started
+    except Exception as e:
+        return None
+
+# settings a --config file may hold, named like the long options, and reapplied on SIGHUP
+CONFIG_KEYS = {
+    'min_period': float, 'decimals': int, 'alt_precision': float, 'min_distance': float,
+    'max_period': float, 'speed_factor': float, 'sky_period': float,
+    'share': bool, 'use_shared': bool, 'password': str,
+    'share_period': float, 'share_distance': float, 'share_max_period': float, 'pwngrid_timeout': float,
+    'log_level': str, 'stats_interval': float, 'trace': int,
+}
+
+def load_config(path):
+    """Settings from a TOML (.toml) or JSON config file, checked and converted. Raises ValueError"""
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        if path.endswith(".toml"):
+            try:
+                import tomllib
+            except ImportError:
+                try:
+                    import tomli as tomllib
+                except ImportError:
+                    raise ValueError("TOML needs Python 3.11 or tomli installed with pip, or use a JSON config")
+            conf = tomllib.loads(data.decode())
+        else:
+            conf = json.loads(data)
+    except ValueError as e:
+        raise ValueError("%s: %s" % (path, e))
+    if not isinstance(conf, dict):
+        raise ValueError("%s: expected a table of settings" % (path))
+
+    settings = {}
+    for (key, value) in conf.items():
+        name = key.replace("-", "_")
+        kind = CONFIG_KEYS.get(name)
+        if kind is None:
+            logging.warning("%s: ignoring unknown setting %s", path, key)
+            continue
+        if kind is bool and not isinstance(value, bool):
+            raise ValueError("%s: %s should be true or false" % (path, key))
+        try:
+            settings[name] = kind(value)
+        except (TypeError, ValueError) as e:
+            raise ValueError("%s: bad %s %r" % (path, key, value))
+    if 'log_level' in settings:
+        level = logging.getLevelName(settings['log_level'].upper())
+        if not isinstance(level, int):
+            raise ValueError("%s: unknown log_level %s" % (path, settings['log_level']))
+        settings['log_level'] = level
+    return settings
 
 #
 # Feature Creep
@@ -43,123 +180,1874 @@ from pwnagotchi import grid as pwngrid
 #          weight = this_ap[rssi] - worst_rssi          # smaller negative minus big negative = positive
 # [ ] 
 
+TRACK_DIR = "/etc/pwnagotchi/pwn_gpsd"
+
 class PWN_GPSD_Proxy:
-    def __init__(self, host, port, watch=False, password="Friendship"):
-        try:
-            self.host = host
-            self.port = port
-            self.watch = watch
-            self.socket = None
-            self.stream = None
-            self.password = password
-            
-            if host:
-                self.connect()
-        except Exception as e:
-            self.socket = None
-            self.stream = None
-
-    def generate_key(self):
-        """Generate a Fernet key from a password"""
-        if self.password:
-            ekey = hashlib.sha256(self.password.encode()).digest()
-            return base64.urlsafe_b64encode(ekey)
-        else:
-            return None
-    
+    def __init__(self, host, port, watch=False, password="Friendship", backoff_min=1, backoff_max=60, priority=0):
+        self.host = host
+        self.port = port
+        self.watch = watch
+        self.reader = None
+        self.writer = None
+        self.password = password
+        self.backoff_min = backoff_min  # first wait before reconnecting
+        self.backoff_max = backoff_max  # longest wait between attempts
+        self.failures = 0               # connections lost or refused since data last came in
+        self.priority = priority        # lower is preferred when fixes are equally good
+        self.mode = 0                   # fix mode of the last TPV from this gpsd
+        self.eph = None                 # horizontal error estimate of the last TPV, meters
+        self.last_tpv = 0               # monotonic time of the last TPV
+
+    @property
+    def name(self):
+        return "%s:%s" % (self.host, self.port)
+
+    def note_tpv(self, tpv):
+        self.mode = tpv.get('mode', 0)
+        self.eph = tpv.get('eph', None)
+        self.last_tpv = time.monotonic()
+
+    def rank(self, stale_after):
+        """Sort key for picking an upstream, bigger is better: a fresh fix, then mode, priority and eph"""
+        fresh = self.writer is not None and time.monotonic() - self.last_tpv < stale_after
+        mode = self.mode if fresh else 0
+        return (mode > 1, mode, -self.priority, -(self.eph if self.eph is not None else math.inf))
+
     def encrypt_data(self, obj):
         """Encrypts a message with a password."""
-        f = Fernet(self.generate_key())
-        data = json.dumps(obj)
-        encrypted_message = f.encrypt(data.encode()).decode()
-        logging.debug("Encrypted to %s" % encrypted_message)
+        encrypted_message = pwnshare.encrypt_location(obj, self.password)
+        logging.debug("Encrypted to %s", encrypted_message)
         return encrypted_message
 
-    def decrypt_data(self, encrypted_message, default=None):
-        """Decrypts a message with a password."""
-        if encrypted_message:
-            f = Fernet(self.generate_key())
-            decrypted_message = f.decrypt(encrypted_message.encode()).decode()
+    def decrypt_location(self, encrypted_message):
+        """Decrypts a shared location to a TPV dict, or None"""
+        return pwnshare.location_cache((self.password,)).decrypt(encrypted_message)
+
+    async def connect(self):
+        if self.writer:
+            logging.info("Closing old connection %r", self.writer)
+            self.close()
+
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+    async def reconnect(self):
+        """Connect, retrying with jittered exponential backoff until it works"""
+        while True:
+            if self.failures:
+                delay = min(self.backoff_min * 2 ** (self.failures - 1), self.backoff_max)
+                delay *= random.uniform(0.5, 1.0)
+                logging.info("Connecting to gpsd %s:%s in %0.1fs", self.host, self.port, delay)
+                await asyncio.sleep(delay)
             try:
-                return json.loads(decrypted_message)
-            except Exception as e:
-                logging.error("Got text not json: %s" % decrypted_message)
-                return decrypted_message
-        else:
-            return default
-
-    def connect(self):
-      try:
-        if self.socket:
-            logging.info("Closing old socket %s" % repr(self.socket))
-            self.socket.close()
-            self.socket = None
-
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.connect((self.host, self.port))
-        self.stream = self.socket.makefile(mode="rw")
-
-#        self.stream.write('?WATCH={"enable":true};\n')
-#        self.stream.flush()
-        #self.socket.send('?WATCH={"enable":true};\n'.encode(encoding="utf-8"))
-
+                await self.connect()
+                logging.info("Connected to gpsd %s:%s", self.host, self.port)
+                return
+            except OSError as e:
+                self.failures += 1
+                logging.warning("gpsd %s:%s: %s", self.host, self.port, e)
 
-      except Exception as e:
-          logging.exception("Connect error: %s" % repr(e))
+    def close(self):
+        if self.writer:
+            try:
+                self.writer.close()
+            except Exception as e:
+                logging.debug(e)
+        self.reader = None
+        self.writer = None
 
-    def read(self):
+    async def read(self):
         try:
-            if not self.socket:
+            if not self.reader:
                 logging.warning("Reconnecting to read")
-                self.connect()
+                await self.connect()
 
-            self.raw = self.stream.readline()
-            logging.debug("Read: %s" % (self.raw.strip()))
-
-#            self.data = json.loads(self.raw)
-#            if self.data.get('class', None) == "VERSION":
-#                self.stream.write('?WATCH={"enable":true};\n')
-#                self.stream.flush()
-#                self.write('?DEVICES;\n')
-                
-            
+            self.raw = await self.reader.readline()
+            if self.raw:
+                self.failures = 0
             return self.raw
         except Exception as e:
-            logging.exception("Read error: %s" % e)
-            self.socket.close
+            logging.error("Read error: %s", e)
+            self.close()
             raise
 
     def write(self, data):
-        logging.info("Writing %s to gpsd" % data.replace("\n", "\n\t").strip())
-        ret = self.stream.write(data)
-        self.stream.flush()
-        return ret
+        logging.info("Writing %s to gpsd", data.replace("\n", "\n\t").strip())
+        self.writer.write(data.encode())
+        return len(data)
+
+json_loads = orjson.loads if orjson else json.loads
+
+class PWN_GPSMessage:
+    """A gpsd report as received.
+
+    The class is sniffed from the start of the line. TPV pacing fields are
+    picked out with a regex, and the full object is only decoded if
+    something asks for it. Forwarding uses the original bytes."""
+    __slots__ = ("line", "m_class", "_raw", "_data", "_fields", "_sky")
+
+    CLASS_PREFIX = b'{"class":"'
+    CLASS_RE = re.compile(rb'"class"\s*:\s*"(\w+)"')
+    # fields the TPV pacing and WATCH device filter look at
+    FIELDS = (b"mode", b"time", b"lat", b"lon", b"alt", b"altMSL", b"speed", b"eph", b"identity", b"device")
+    FIELDS_RE = re.compile(rb'"(' + b"|".join(FIELDS) + rb')"\s*:\s*("[^"]*"|[-+.0-9eE]+)')
+    TIME_RE = re.compile(rb'"time"\s*:\s*"[^"]*",?')
+
+    def __init__(self, line, data=None):
+        if isinstance(line, str):
+            line = line.encode()
+        if not line.endswith(b"\n"):
+            # terminate once here, so fan-out can share the same bytes with every client
+            line += b"\n"
+        self.line = line
+        self._raw = None
+        self._data = data
+        self._fields = None
+        self._sky = None
+        if data is not None:
+            self.m_class = data.get('class', None)
+        elif line.startswith(self.CLASS_PREFIX):
+            n = len(self.CLASS_PREFIX)
+            self.m_class = line[n:line.find(b'"', n)].decode()
+        else:
+            m = self.CLASS_RE.search(line)
+            self.m_class = m.group(1).decode() if m else None
+
+    @property
+    def raw(self):
+        """the line as text"""
+        if self._raw is None:
+            self._raw = self.line.decode(errors="replace")
+        return self._raw
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = json_loads(self.line)
+        return self._data
+
+    @property
+    def fields(self):
+        """The TPV fields used for pacing, without decoding the whole message. Always
+        read from the line, so it is the same subset whether or not .data was used"""
+        if self._fields is None:
+            self._fields = {}
+            for (k, v) in self.FIELDS_RE.findall(self.line):
+                if v[0] == 34: # '"'
+                    self._fields[k.decode()] = v[1:-1].decode()
+                elif k == b"mode":
+                    self._fields['mode'] = int(v)
+                else:
+                    self._fields[k.decode()] = float(v)
+        return self._fields
+
+    @property
+    def sky(self):
+        """For a SKY: ((nSat, PRNs in use), the line without its time). The first is None
+        when the report has no satellite list, as gpsd sends with just DOPs"""
+        if self._sky is None:
+            sats = self.data.get('satellites')
+            if sats is None:
+                in_use = None
+            else:
+                in_use = (self.data.get('nSat', len(sats)), frozenset(s.get('PRN') for s in sats if s.get('used')))
+            self._sky = (in_use, self.TIME_RE.sub(b"", self.line))
+        return self._sky
+
+    def get(self, key, default=None):
+        if key.encode() in self.FIELDS:
+            return self.fields.get(key, default)
+        return self.data.get(key, default)
 
 class PWN_GPSClient:
-    def __init__(self, socket, address):
+    # message classes that can be dropped from a full queue, oldest first
+    DROPPABLE = ("TPV", "SKY")
+    # queued messages handed to the kernel in one sendmsg call
+    IOV_MAX = 64
+    SCATTER = hasattr(socket.socket, "sendmsg")
+
+    def __init__(self, socket, address, max_queue=32, high_water=65536, max_latency=30):
         self.socket = socket
         self.address = address
-        self.watch = {}
-        self.stream = self.socket.makefile(mode="rw")
+        self.watch = PWN_Subscription()
+        self.evicted = None
+        self._inbuf = b""
+
+        self.outq = deque()         # (class, bytes) waiting to be sent
+        self.out_offset = 0         # bytes of outq[0] already sent
+        self.out_bytes = 0          # unsent bytes in outq
+        self.last_progress = 0      # last time the socket took data, or the queue became non-empty
+        self.max_queue = max_queue
+        self.high_water = high_water    # evict when more than this many bytes are unsent
+        self.max_latency = max_latency  # evict when a message has waited this many seconds
+        self.dropped = 0
+        self.bytes_sent = 0
+
+    def queue(self, data, m_class=None):
+        """Add encoded data to the outbound queue, dropping the oldest TPV/SKY when full.
+        Returns True if the queue was empty, so the socket needs watching for writability"""
+        if self.max_queue and len(self.outq) >= self.max_queue:
+            # never drop the head if it is partly sent
+            for i in range(1 if self.out_offset else 0, len(self.outq)):
+                if self.outq[i][0] in self.DROPPABLE:
+                    self.out_bytes -= len(self.outq[i][1])
+                    del self.outq[i]
+                    self.dropped += 1
+                    log_limited("queue full", logging.DEBUG, "Queue full for %s, dropped old message (%d total)",
+                                self.address, self.dropped)
+                    break
+        was_empty = not self.outq
+        if was_empty:
+            self.last_progress = time.monotonic()
+        self.outq.append((m_class, data))
+        self.out_bytes += len(data)
+        return was_empty
+
+    def stalled_for(self):
+        """Seconds with data queued but none accepted by the socket"""
+        return time.monotonic() - self.last_progress if self.outq else 0
+
+    def overloaded(self):
+        """Return why this client is too far behind to keep, or None"""
+        if self.high_water and self.out_bytes > self.high_water:
+            return "backlog %d bytes over high-water mark %d" % (self.out_bytes, self.high_water)
+        stalled = self.stalled_for()
+        if self.max_latency and stalled > self.max_latency:
+            return "no data accepted for %0.1fs" % stalled
+        return None
+
+    def send_pending(self):
+        """Send as much of the queue as the socket will take. Returns bytes sent.
+
+        Queued messages are the same bytes objects every client shares, so
+        they go out with sendmsg scatter-gather instead of being joined."""
+        sent = 0
+        while self.outq:
+            head = memoryview(self.outq[0][1])[self.out_offset:]
+            try:
+                if self.SCATTER and len(self.outq) > 1:
+                    bufs = [head]
+                    bufs.extend(data for (m_class, data) in itertools.islice(self.outq, 1, self.IOV_MAX))
+                    n = self.socket.sendmsg(bufs)
+                else:
+                    n = self.socket.send(head)
+            except (BlockingIOError, InterruptedError):
+                break
+            sent += n
+            # retire what went out completely
+            n += self.out_offset
+            while self.outq and n >= len(self.outq[0][1]):
+                n -= len(self.outq[0][1])
+                self.outq.popleft()
+            self.out_offset = n
+            if n:
+                break   # socket buffer is full
+        if sent:
+            self.last_progress = time.monotonic()
+        self.out_bytes -= sent
+        self.bytes_sent += sent
+        return sent
+
+    def recv_lines(self):
+        """Read what the socket has. Returns (complete lines, False once the client has gone)"""
+        try:
+            chunk = self.socket.recv(4096)
+        except (BlockingIOError, InterruptedError):
+            return ([], True)
+        except (ConnectionResetError, ConnectionAbortedError):
+            chunk = b""
+        if not chunk:
+            (lines, self._inbuf) = ([self._inbuf] if self._inbuf else [], b"")
+            return ([l.decode(errors="replace") for l in lines], False)
+        self._inbuf += chunk
+        *lines, self._inbuf = self._inbuf.split(b"\n")
+        return ([l.decode(errors="replace") + "\n" for l in lines], True)
+
+class PWN_TrackWriter:
+    """Daily track logs that stay open between writes.
+
+    Lines are batched by the caller and written together. Each log follows
+    the date in its file name, so it rotates at midnight, and current.txt
+    is replaced atomically. Runs in an executor, one call at a time.
+
+    Tracks are written as text, as pwntrack binary records, or both."""
+
+    def __init__(self, track_dir=TRACK_DIR, flush_interval=10, fsync_interval=300, track_format="text"):
+        if track_format not in ("text", "binary", "both"):
+            raise ValueError("Unknown track format %s" % track_format)
+        global pwntrack
+        if track_format != "text" and not pwntrack:
+            pwntrack = lazy_import("pwntrack")
+        if track_format != "text" and not pwntrack:
+            raise ValueError("Binary tracks need pwntrack.py installed next to pwn-gpsd.py")
+        self.track_dir = track_dir
+        self.text = track_format in ("text", "both")
+        self.binary = track_format in ("binary", "both")
+        self.flush_interval = flush_interval    # seconds between batched writes
+        self.fsync_interval = fsync_interval    # seconds between fsyncs, 0 to leave it to the OS
+        self.files = {}                         # fname format -> (path, open file)
+        self.last_fsync = time.monotonic()
+        self._day = None
+        self._paths = {}                        # fname format -> path for today
+
+    def path_for(self, fname_fmt):
+        """Today's file for a strftime file name format"""
+        now = datetime.now()
+        if now.day != self._day:
+            self._day = now.day
+            self._paths = {}
+        if fname_fmt not in self._paths:
+            self._paths[fname_fmt] = os.path.join(self.track_dir, now.strftime(fname_fmt))
+        return self._paths[fname_fmt]
+
+    def entries(self, fname_fmt, line, tpv=None):
+        """Log entries for one location, in each enabled format"""
+        ret = []
+        if self.text:
+            ret.append((fname_fmt, self.path_for(fname_fmt), line))
+        if self.binary and tpv:
+            bin_fmt = pwntrack.binary_name(fname_fmt)
+            ret.append((bin_fmt, self.path_for(bin_fmt), tpv))
+        return ret
 
-    def read(self):
+    def write(self, lines, current=None):
+        """Append (fname format, path, line or TPV) entries, and replace current.txt if given"""
+        if not os.path.isdir(self.track_dir):
+            os.makedirs(self.track_dir)
+        for (fname_fmt, path, line) in lines:
+            (open_path, f) = self.files.get(fname_fmt, (None, None))
+            if open_path != path:
+                if f:
+                    logging.info("Rotating track %s -> %s", open_path, path)
+                    self._close(f)
+                f = pwntrack.TrackFile(path) if isinstance(line, dict) else open(path, "a")
+                self.files[fname_fmt] = (path, f)
+            f.write(line)
+        for (path, f) in self.files.values():
+            f.flush()
+        if current is not None:
+            self.write_current(current)
+        if self.fsync_interval and time.monotonic() - self.last_fsync >= self.fsync_interval:
+            self.last_fsync = time.monotonic()
+            for (path, f) in self.files.values():
+                os.fsync(f.fileno())
+
+    def write_current(self, text):
+        fname = os.path.join(self.track_dir, "current.txt")
+        tmp = fname + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, fname)
+
+    def _close(self, f):
         try:
-            self.raw = self.stream.readline()
-            #logging.info("%s read '%s'" % (self.address, self.raw))
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+        except Exception as e:
+            logging.error("Closing track %s: %s", f.name, e)
+
+    def close(self):
+        for (path, f) in self.files.values():
+            self._close(f)
+        self.files = {}
+
+def start_thread(func, *args, name=None):
+    """Run func in a new daemon thread and return a Future for its result.
+    A call that never returns keeps its thread, but not the caller or exit."""
+    fut = Future()
+    def work():
+        if fut.set_running_or_notify_cancel():
             try:
-                if self.raw != "":
-                    self.data = json.loads(raw)
+                fut.set_result(func(*args))
+            except BaseException as e:
+                fut.set_exception(e)
+    threading.Thread(target=work, name=name, daemon=True).start()
+    return fut
+
+class PWN_PeerPoller:
+    """Polls pwngrid for friend locations in the background.
+
+    Each poll runs in its own thread with a hard timeout, so a hung
+    pwngrid-peer only costs that thread. Failures back off exponentially.
+    The last good list of friend locations is kept in snapshot, which
+    the proxy can read at any time without waiting."""
+
+    def __init__(self, fetch, interval=10, timeout=5, max_backoff=300):
+        self.fetch = fetch               # blocking call returning a list of friend TPVs
+        self.interval = interval         # seconds between polls
+        self.timeout = timeout           # seconds before a poll is given up on
+        self.max_backoff = max_backoff   # longest wait between failing polls
+        self.snapshot = []
+        self.snapshot_time = 0
+        self.failures = 0
+        self.polls = 0
+        self.attempts = 0                # polls tried, including ones refused while one is stuck
+        self.errors = 0
+        self.timeouts = 0
+        self.latency = deque(maxlen=64)  # seconds taken by recent good polls
+        self.pending = None              # Future of the poll in progress
+
+    def _timed_fetch(self):
+        t0 = time.monotonic()
+        return (self.fetch(), time.monotonic() - t0)
+
+    async def poll(self):
+        """Run one poll, returning the friend locations"""
+        if self.pending and not self.pending.done():
+            # the previous poll is still stuck in pwngrid, don't pile up threads
+            raise TimeoutError("previous pwngrid poll still running")
+        self.pending = start_thread(self._timed_fetch, name="pwngrid poll")
+        self.polls += 1
+        (locs, elapsed) = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(self.pending)),
+                                                 self.timeout)
+        self.latency.append(elapsed)
+        return locs
+
+    def next_delay(self):
+        if not self.failures:
+            return self.interval
+        delay = min(self.interval * 2 ** self.failures, self.max_backoff)
+        return delay * random.uniform(0.75, 1.0)
+
+    async def run(self, on_update):
+        """Poll forever, calling on_update(friend_locs) after each good poll that found friends"""
+        while True:
+            self.attempts += 1
+            try:
+                locs = await self.poll()
+                self.failures = 0
+                self.snapshot = locs
+                self.snapshot_time = time.time()
+                logging.debug("pwngrid poll: %d friends in %0.3fs", len(locs), self.latency[-1])
+                if locs:
+                    on_update(locs)
+            except (TimeoutError, asyncio.TimeoutError) as e:
+                self.timeouts += 1
+                self.failures += 1
+                logging.warning("pwngrid poll timed out after %ss (%d in a row)", self.timeout, self.failures)
             except Exception as e:
-                self.data = {}
-            
-            return self.raw
+                self.errors += 1
+                self.failures += 1
+                logging.error("Pwngrid error: %s", e)
+            if self.attempts % 30 == 0:
+                logging.info("pwngrid poller: %s", self.stats())
+            await asyncio.sleep(self.next_delay())
+
+    def stats(self):
+        lat = list(self.latency)
+        return {'polls': self.polls, 'errors': self.errors, 'timeouts': self.timeouts,
+                'friends': len(self.snapshot),
+                'age': round(time.time() - self.snapshot_time, 1) if self.snapshot_time else None,
+                'latency_last': round(lat[-1], 3) if lat else None,
+                'latency_mean': round(sum(lat) / len(lat), 3) if lat else None,
+                'latency_max': round(max(lat), 3) if lat else None}
+
+def distance_m(a, b):
+    """Great circle distance in meters between two TPV dicts"""
+    (lat1, lon1, lat2, lon2) = map(math.radians, (a['lat'], a['lon'], b['lat'], b['lon']))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371008.8 * math.asin(min(1.0, math.sqrt(h)))
+
+def approx_distance_m(a, b):
+    """Equirectangular distance in meters between two TPV dicts. Close enough over a few km"""
+    lat1 = math.radians(a['lat'])
+    lat2 = math.radians(b['lat'])
+    x = math.radians(b['lon'] - a['lon']) * math.cos((lat1 + lat2) / 2)
+    return 6371008.8 * math.hypot(x, lat2 - lat1)
+
+class PWN_Pacer:
+    """Decides which TPVs are worth sending on.
+
+    A fix goes out once it has moved min_distance meters, or min_alt meters
+    up or down, or changed mode, and min_period seconds have passed since
+    the last one. Every max_period seconds one goes out regardless. With
+    speed_factor set, moving at v m/s needs a move of v * speed_factor
+    meters when that is more than min_distance, so fast travel is not
+    reported every few meters."""
+
+    def __init__(self, min_distance=11, min_alt=1, min_period=10, max_period=60, speed_factor=0):
+        self.min_distance = min_distance
+        self.min_alt = min_alt
+        self.min_period = min_period
+        self.max_period = max_period
+        self.speed_factor = speed_factor
+
+    @staticmethod
+    def decimals_to_m(ll_decimals):
+        """Meters of latitude in the last of ll_decimals decimal places"""
+        return 6371008.8 * math.radians(10 ** -ll_decimals)
+
+    def threshold(self, tpv):
+        speed = tpv.get('speed') or 0
+        return max(self.min_distance, speed * self.speed_factor)
+
+    def check(self, tpv, last_tpv, elapsed):
+        """Why tpv should be sent, given the last one sent elapsed seconds ago, or None"""
+        mode = tpv.get('mode', -1)
+        if mode > 1 and elapsed >= self.min_period:
+            if mode != last_tpv.get('mode', -1) or 'lat' not in last_tpv:
+                return "mode %s" % mode
+            try:
+                moved = approx_distance_m(tpv, last_tpv)
+            except (KeyError, TypeError):
+                moved = 0
+            if moved >= self.threshold(tpv):
+                return "moved %0.1fm" % moved
+            alt = tpv.get('alt', tpv.get('altMSL'))
+            last_alt = last_tpv.get('alt', last_tpv.get('altMSL'))
+            if alt is not None and last_alt is not None and abs(alt - last_alt) >= self.min_alt:
+                return "climbed %0.1fm" % (alt - last_alt)
+        if elapsed >= self.max_period:
+            return "max period"
+        return None
+
+class PWN_Subscription:
+    """What a client asked for with ?WATCH.
+
+    Honors the gpsd options enable, json, nmea, raw and device. The
+    pwn-gpsd extensions min_period, min_distance, min_alt, max_period and
+    speed_factor give the client its own TPV pacing instead of the proxy's,
+    and sky_period sets how often it gets SKY reports, besides the ones
+    sent when the satellites in use change."""
+
+    PACING = ("min_period", "min_distance", "min_alt", "max_period", "speed_factor")
+
+    def __init__(self, watch=None, pacer=None, sky_period=4):
+        self.watch = watch or {}
+        self.enable = bool(self.watch.get('enable', False))
+        self.nmea = bool(self.watch.get('nmea', False)) or int(self.watch.get('raw', 0)) > 0
+        self.json = bool(self.watch.get('json', not self.nmea))
+        self.device = self.watch.get('device', None)
+        self.set_defaults(pacer, sky_period)
+        self.last_tpv = {}      # fields of the last TPV sent, for our own pacing
+        self.last_tpv_time = 0
+        self.last_sky_time = 0
+        self.last_sky = None    # SKY payload last sent, without its time
+        self.last_sky_sats = None
+
+    def set_defaults(self, pacer, sky_period):
+        """Take what the client did not ask for from the proxy's settings. Called again after a reload"""
+        self.sky_period = float(self.watch.get('sky_period', sky_period))
+        self.pacer = None
+        own = {k: float(self.watch[k]) for k in self.PACING if k in self.watch}
+        if own and pacer:
+            settings = {k: getattr(pacer, k) for k in self.PACING}
+            settings.update(own)
+            self.pacer = PWN_Pacer(**settings)
+
+    def wants(self, msg):
+        """Whether a JSON report goes to this client at all"""
+        if not (self.enable and self.json):
+            return False
+        if not self.device:
+            return True
+        # DEVICE reports name the device as path. Others are only decoded if they lack device
+        dev = msg.get('device') or (msg.get('path') if msg.m_class == 'DEVICE' else None)
+        return not dev or dev == self.device
+
+    def tpv_due(self, tpv, now):
+        """With its own pacing, whether this TPV is due"""
+        return self.pacer.check(tpv, self.last_tpv, now - self.last_tpv_time) is not None
+
+    def sent_tpv(self, tpv, now):
+        self.last_tpv = tpv
+        self.last_tpv_time = now
+
+    def sky_due(self, sky, now):
+        """Whether a SKY goes to this client: never a repeat of the last one sent, at once
+        when nSat or the satellites in use change, otherwise every sky_period seconds"""
+        (in_use, payload) = sky
+        if payload == self.last_sky:
+            return False
+        if (in_use is not None and in_use != self.last_sky_sats) or now - self.last_sky_time >= self.sky_period:
+            self.sent_sky(sky, now)
+            return True
+        return False
+
+    def sent_sky(self, sky, now):
+        (in_use, self.last_sky) = sky
+        if in_use is not None:
+            self.last_sky_sats = in_use
+        self.last_sky_time = now
+
+class PWN_AdvertPublisher:
+    """Publishes our location in the pwngrid advertisement in the background.
+
+    Only the latest location is kept, so a burst of TPVs makes one update.
+    Updates go out at most every min_period seconds, and only after moving
+    min_distance meters or a change in fix mode, or once max_period seconds
+    have passed, so peers keep seeing a unit that is parked. Like
+    PWN_PeerPoller, each update runs in its own thread with a hard timeout."""
+
+    def __init__(self, publish, min_period=10, min_distance=10, timeout=5, max_period=60):
+        self.publish = publish           # blocking call taking the raw TPV line
+        self.min_period = min_period
+        self.min_distance = min_distance
+        self.max_period = max_period     # seconds before the same location is published again
+        self.timeout = timeout
+        self.latest = None               # (raw, tpv) waiting to go out
+        self.sent = None                 # last tpv published
+        self.sent_raw = None             # and its line, to publish again after max_period
+        self.last_publish = 0
+        self.wakeup = None
+        self.pending = None              # Future of the update in progress
+        self.published = 0
+        self.skipped = 0
+        self.errors = 0
+        self.timeouts = 0
+
+    def offer(self, raw, tpv):
+        """Queue a location for publishing, replacing any that has not gone out yet"""
+        self.latest = (raw, tpv)
+        if self.wakeup:
+            self.wakeup.set()
+
+    def wanted(self, tpv):
+        if not self.sent or tpv.get('mode') != self.sent.get('mode'):
+            return True
+        if self.max_period and time.monotonic() - self.last_publish >= self.max_period:
+            # peer_map drops peers whose advertisement has not changed in a while
+            return True
+        try:
+            return distance_m(tpv, self.sent) >= self.min_distance
+        except (KeyError, TypeError):
+            return True
+
+    def retry(self, raw, tpv):
+        if not self.latest:
+            self.latest = (raw, tpv)
+            self.wakeup.set()
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        if self.latest:
+            self.wakeup.set()
+        while True:
+            if self.max_period and self.sent_raw is not None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(),
+                                           max(self.last_publish + self.max_period - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    # nothing new came along: publish the same location again, freshly encrypted
+                    self.latest = (self.sent_raw, self.sent)
+            else:
+                await self.wakeup.wait()
+            # anything offered while waiting out the rate limit replaces this one
+            delay = self.last_publish + self.min_period - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.wakeup.clear()
+            (raw, tpv) = self.latest
+            self.latest = None
+            if not self.wanted(tpv):
+                self.skipped += 1
+                continue
+
+            self.last_publish = time.monotonic()
+            try:
+                if self.pending and not self.pending.done():
+                    raise TimeoutError("previous pwngrid update still running")
+                self.pending = start_thread(self.publish, raw, name="pwngrid advert")
+                await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(self.pending)), self.timeout)
+                self.sent = tpv
+                self.sent_raw = raw
+                self.published += 1
+            except (TimeoutError, asyncio.TimeoutError) as e:
+                self.timeouts += 1
+                logging.warning("pwngrid advertisement update timed out: %s", e or self.timeout)
+                self.retry(raw, tpv)
+            except Exception as e:
+                self.errors += 1
+                logging.error("pwngrid advertisement update failed: %s", e)
+                self.retry(raw, tpv)
+
+    def stats(self):
+        return {'published': self.published, 'skipped': self.skipped,
+                'errors': self.errors, 'timeouts': self.timeouts}
+
+def raise_nofile_limit():
+    """Raise the soft open file limit to the hard limit, so many clients can connect"""
+    try:
+        import resource
+        (soft, hard) = resource.getrlimit(resource.RLIMIT_NOFILE)
+        want = hard if hard != resource.RLIM_INFINITY else max(soft, 65536)
+        if soft != resource.RLIM_INFINITY and soft < want:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (want, hard))
+            logging.info("Open file limit raised from %d to %d", soft, want)
+    except Exception as e:
+        logging.warning("Could not raise open file limit: %s", e)
+
+class PWN_Histogram:
+    """Counts of durations in fixed buckets, plus total, min and max. Cheap enough for the hot path"""
+    BOUNDS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)   # seconds
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.n = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.n += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if self.min is None or value < self.min:
+            self.min = value
+
+    def quantile(self, q):
+        """Estimate of the q quantile, interpolated within its bucket. The bucket
+        edges are narrowed to the smallest and largest values seen"""
+        want = q * self.n
+        seen = 0
+        for (i, count) in enumerate(self.counts):
+            if count and seen + count >= want:
+                lower = max(self.bounds[i - 1] if i else 0.0, self.min)
+                upper = min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+                return lower + (upper - lower) * max(want - seen, 0) / count
+            seen += count
+        return 0.0
+
+    def summary(self):
+        """n, mean, p50, p99 and max, in milliseconds"""
+        ms = lambda v: round(v * 1000, 3)
+        return {'n': self.n, 'mean': ms(self.total / self.n) if self.n else 0,
+                'p50': ms(self.quantile(0.5)), 'p99': ms(self.quantile(0.99)), 'max': ms(self.max)}
+
+class PWN_Stats:
+    """Counters and latency histograms behind ?STATS and the periodic summary"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.lines = {}                       # gpsd lines by class
+        self.tpv = {'sent': 0, 'paced': 0, 'repeat': 0, 'no_alt': 0}
+        self.handle = PWN_Histogram()         # time to process one gpsd line
+        self.loop_lag = PWN_Histogram()       # how late the event loop ran timer jobs
+        self.track_write = PWN_Histogram()    # time to write a batch of track lines
+        self.last_lines = {}                  # lines at the last summary, for rates
+        self.last_summary = self.started
+
+    def count_line(self, m_class):
+        # lines without a class are counted as "?", so the keys always sort
+        m_class = m_class or "?"
+        self.lines[m_class] = self.lines.get(m_class, 0) + 1
+
+    def rates(self):
+        """Lines per second by class since the last call"""
+        now = time.time()
+        elapsed = max(now - self.last_summary, 0.001)
+        rates = {k: round((v - self.last_lines.get(k, 0)) / elapsed, 2) for (k, v) in self.lines.items()}
+        self.last_lines = dict(self.lines)
+        self.last_summary = now
+        return rates
+
+class PWN_Timers:
+    """Named deadlines sharing one event loop timer.
+
+    A job is a callable run at its deadline. If it returns a number it runs
+    again that many seconds later, otherwise it is dropped until scheduled
+    again. Only the earliest deadline is armed with the loop, so the proxy
+    sleeps until something is due or a socket has data, and not at all on
+    a timer nobody needs."""
+
+    def __init__(self, loop, on_late=None):
+        self.loop = loop
+        self.on_late = on_late   # called with how late each job ran, in seconds
+        self.heap = []           # (deadline, seq, name), stale entries skipped when popped
+        self.jobs = {}           # name -> (deadline, seq, func)
+        self.seq = itertools.count()
+        self.handle = None
+        self.armed_for = None
+
+    def schedule(self, name, delay, func):
+        """Run func in delay seconds, replacing any job with the same name"""
+        deadline = self.loop.time() + max(delay, 0)
+        seq = next(self.seq)
+        self.jobs[name] = (deadline, seq, func)
+        heapq.heappush(self.heap, (deadline, seq, name))
+        self._arm()
+
+    def sooner(self, name, delay, func):
+        """Schedule, unless the job is already due within delay seconds"""
+        job = self.jobs.get(name)
+        if job is None or job[0] > self.loop.time() + delay:
+            self.schedule(name, delay, func)
+
+    def cancel(self, name):
+        if self.jobs.pop(name, None):
+            self._arm()
+
+    def due_in(self, name):
+        """Seconds until a job runs, or None if it is not scheduled"""
+        job = self.jobs.get(name)
+        return job[0] - self.loop.time() if job else None
+
+    def close(self):
+        self.jobs = {}
+        self.heap = []
+        self._arm()
+
+    def _current(self, entry):
+        job = self.jobs.get(entry[2])
+        return job is not None and job[1] == entry[1]
+
+    def _arm(self):
+        while self.heap and not self._current(self.heap[0]):
+            heapq.heappop(self.heap)
+        deadline = self.heap[0][0] if self.heap else None
+        if deadline == self.armed_for and (self.handle or deadline is None):
+            return
+        if self.handle:
+            self.handle.cancel()
+            self.handle = None
+        self.armed_for = deadline
+        if deadline is not None:
+            self.handle = self.loop.call_at(deadline, self._run)
+
+    def _run(self):
+        self.handle = None
+        self.armed_for = None
+        now = self.loop.time()
+        while self.heap and self.heap[0][0] <= now:
+            entry = heapq.heappop(self.heap)
+            if not self._current(entry):
+                continue
+            (deadline, seq, name) = entry
+            func = self.jobs.pop(name)[2]
+            if self.on_late:
+                self.on_late(now - deadline)
+            try:
+                again = func()
+            except Exception as e:
+                logging.exception("Timer %s: %s", name, e)
+                again = None
+            if again is not None and name not in self.jobs:
+                self.schedule(name, again, func)
+        self._arm()
+
+class PWN_GPSD_Server:
+    """gpsd proxy with pacing, run on asyncio.
+
+    Each gpsd upstream and the pwngrid poller and publisher run as separate
+    tasks. Client sockets stay registered with the event loop for reading,
+    and for writing only while they have something queued. Everything
+    periodic (heartbeats, stalled clients, failover, track flushes, stats)
+    is a PWN_Timers job, so an idle proxy only wakes when one is due.
+    Anything that can block (pwngrid API, Fernet, file writes) runs in an
+    executor or its own thread, so TPV delivery is never held up by it."""
+
+    def __init__(self, gpsd, port=7492, min_period=10, ll_decimals=4, alt_min_chg=1,
+                 share=False, use_shared=False, keep_going=-1, max_queue=32,
+                 high_water=65536, max_latency=30, tracks=None, pwngrid_timeout=5,
+                 share_period=10, share_distance=10, share_max_period=60, min_distance=None, max_period=60, speed_factor=0,
+                 sky_period=4, upstreams=None, stale_after=5, stats_interval=300, capture=None, trace=0,
+                 config=None):
+        self.gpsd = gpsd
+        # gpsd instances to read, the best one feeds the clients
+        self.upstreams = upstreams if upstreams else ([gpsd] if gpsd.host else [])
+        self.active = self.upstreams[0] if self.upstreams else None
+        self.stale_after = stale_after   # seconds without a TPV before an upstream is passed over
+        self.port = port
+        self.min_period = min_period
+        self.ll_decimals = ll_decimals
+        self.alt_min_chg = alt_min_chg
+        self.pacer = PWN_Pacer(PWN_Pacer.decimals_to_m(ll_decimals) if min_distance is None else min_distance,
+                               alt_min_chg, min_period, max_period, speed_factor)
+        self.sky_period = sky_period     # default seconds between SKY reports to each client
+        self.upstream_nmea = False       # whether gpsd was asked for NMEA
+        self.degraded_tpv = None         # last TPV with no fix, sent while gpsd is away
+        self.min_distance = min_distance # None to follow ll_decimals
+        self.shareWPeers = share
+        self.useSharedLoc = use_shared
+        self.wantPwngrid = share or use_shared
+        if self.wantPwngrid:
+            self.check_sharing(gpsd.password)
+        self.share_period = share_period
+        self.share_distance = share_distance
+        self.share_max_period = share_max_period
+        self.pwngrid_timeout = pwngrid_timeout
+        self.pwngridAdvertising = False
+        self.keep_going = keep_going     # number of gpsd messages to process, -1 forever
+        self.max_queue = max_queue       # messages queued per client before dropping TPV/SKY
+        self.high_water = high_water     # unsent bytes before a client is evicted
+        self.max_latency = max_latency   # seconds a message may wait before a client is evicted
+        self.evictions = 0
+        self.exit_code = 0
+        self.stats = PWN_Stats()
+        self.stats_interval = stats_interval  # seconds between summary log lines, 0 for none
+        self.capture_path = capture      # file to tee raw upstream lines into, for gpsreplay.py
+        self.capture = None
+        self.trace = PWN_Trace(trace) if trace else None   # recent events, dumped on SIGUSR1
+
+        self.server_socket = None
+        self.messages_archive = {}   # keep track of most recent gpsd message of each type
+        self.clients = {}            # client socket -> PWN_GPSClient
+        self.last_tpv_send = 0
+        self.last_share_compare = None
+        self.poll_cache = None       # (TPV, SKY, POLL reply tail) built from those two messages
+
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="pwn-gpsd")
+        self.share_gen = 0           # bumped when a reload changes sharing, see _set_advertisement
+        self.advert_lock = threading.Lock()
+        self.peer_poller = PWN_PeerPoller(self._poll_pwngrid, timeout=pwngrid_timeout) if use_shared else None
+        self.advert_publisher = self.new_publisher() if share else None
+        self.sharing_tasks = []
+        self.advert = None           # our pwngrid advertisement, fetched once and reused
+        self.advert_time = 0
+        self.advert_gen = 0          # share_gen the advertisement was fetched under
+        self.tracks = tracks or PWN_TrackWriter()
+        self.track_lines = []        # (fname format, path, line) waiting for the next track flush
+        self.track_current = None    # latest text for current.txt
+        self.stopping = None
+        self.loop = None
+        self.timers = None
+        self.tasks = []
+        self.flush_task = None       # track write in progress
+
+        # a config file overrides the command line, now and on each SIGHUP
+        self.config_path = config
+        self.cli_settings = self.current_settings()
+        if config:
+            self.apply_config(load_config(config))
+
+    def preload_location(self):
+        # read last loc from current.txt, if not too old
+        fname = os.path.join(self.tracks.track_dir, "current.txt")
+        if os.path.isfile(fname):
+            mtime = os.stat(fname).st_mtime
+            if (time.time() - mtime) < 60 * 60 * 24:
+                with open(fname, 'r') as f:
+                    tpv = f.readlines()
+                    logging.warning("Preload location %s", tpv)
+                    self.messages_archive['TPV'] = PWN_GPSMessage(tpv[-1])
+
+    def open_server_socket(self):
+        n_tries = 3
+        while n_tries and not self.server_socket:
+            try:
+                self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                self.server_socket.bind(("", self.port))
+                self.server_socket.listen(socket.SOMAXCONN)
+                self.server_socket.setblocking(False)
+            except Exception as e:
+                n_tries -= 1
+                self.server_socket = None
+                logging.warning("%d attempts left: %s", n_tries, e)
+                if n_tries > 0:
+                    time.sleep(3)
+                else:
+                    raise
+
+    def stop(self, exit_code=0):
+        if exit_code and not self.exit_code:
+            self.exit_code = exit_code
+        if self.stopping and not self.stopping.is_set():
+            logging.info("Stopping proxy (%d)", exit_code)
+            self.stopping.set()
+
+    async def run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+
+        def term_handler(*unused):
+            logging.info('Received Term.  Closing sockets and exiting')
+            self.stop()
+        loop.add_signal_handler(signal.SIGTERM, term_handler)
+        loop.add_signal_handler(signal.SIGINT, term_handler)
+        loop.add_signal_handler(signal.SIGUSR1, self.dump_trace)
+        loop.add_signal_handler(signal.SIGHUP, self.reload_config)
+
+        self.preload_location()
+        raise_nofile_limit()
+        self.open_server_socket()
+        age = process_age()
+        logging.info("Listening on port %d%s", self.port, ", %0.2fs after launch" % age if age is not None else "")
+        if self.capture_path:
+            self.capture = open(self.capture_path, "ab")
+            logging.info("Capturing gpsd lines to %s", self.capture_path)
+
+        self.loop = loop
+        self.timers = PWN_Timers(loop, on_late=self.stats.loop_lag.add)
+        loop.add_reader(self.server_socket.fileno(), self.accept_ready)
+        if self.pacer.max_period:
+            self.timers.schedule("heartbeat", self.pacer.max_period, self.heartbeat)
+        if len(self.upstreams) > 1:
+            self.timers.schedule("failover", self.stale_after, self.check_upstreams)
+        if self.stats_interval:
+            self.timers.schedule("stats", self.stats_interval, self.log_stats)
+        self.tasks = []
+        for src in self.upstreams:
+            self.tasks.append(asyncio.create_task(self.read_gpsd(src), name="gpsd %s" % src.name))
+        self.start_sharing()
+
+        await self.stopping.wait()
+
+        logging.info("Exiting")
+        if self.peer_poller:
+            logging.info("pwngrid poller: %s", self.peer_poller.stats())
+        if self.advert_publisher:
+            logging.info("pwngrid publisher: %s", self.advert_publisher.stats())
+        self.timers.close()
+        for t in self.tasks + self.sharing_tasks:
+            t.cancel()
+        for cl in list(self.clients.values()):
+            self.close_client(cl)
+        await asyncio.gather(*self.tasks, *self.sharing_tasks, return_exceptions=True)
+        if self.flush_task:
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+        try:
+            self.tracks.write(self.track_lines, self.track_current)
+            self.tracks.close()
         except Exception as e:
-            logging.error("Read error %s: %s" % (self.address, self.raw))
-            raise
+            logging.exception("Closing tracks: %s", e)
+        for src in self.upstreams:
+            src.close()
+        if self.capture:
+            self.capture.close()
+        loop.remove_reader(self.server_socket.fileno())
+        self.server_socket.close()
+        self.executor.shutdown(wait=True)
+        return self.exit_code
+
+    #
+    # clients
+    #
+    def accept_ready(self):
+        """Accept every waiting connection. Called by the loop when the server socket is readable"""
+        while True:
+            try:
+                client_socket, address = self.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                log_limited("accept", logging.ERROR, "Accept failed: %s", e)
+                if e.errno in (errno.EMFILE, errno.ENFILE):
+                    # out of descriptors, stop accepting for a moment
+                    fd = self.server_socket.fileno()
+                    self.loop.remove_reader(fd)
+                    self.loop.call_later(1, self.loop.add_reader, fd, self.accept_ready)
+                return
+            self.add_client(client_socket, address)
+
+    def add_client(self, client_socket, address):
+        client_socket.setblocking(False)
+        cl = PWN_GPSClient(client_socket, address, max_queue=self.max_queue,
+                           high_water=self.high_water, max_latency=self.max_latency)
+        self.clients[client_socket] = cl
+        self.loop.add_reader(client_socket.fileno(), self.client_readable, cl)
+        if self.trace:
+            self.trace.add("connect", address)
+        if 'VERSION' in self.messages_archive:
+            log_limited("version", logging.INFO, "Sending VERSION to %s", address)
+            self.queue_message_for(cl, self.messages_archive['VERSION'].line, 'VERSION')
+
+    def client_readable(self, cl):
+        (lines, connected) = cl.recv_lines()
+        for raw in lines:
+            if raw.startswith("?"):
+                try:
+                    self.handle_client_command(cl, raw)
+                except Exception as e:
+                    logging.exception("Client %s command %s: %s", cl.address, raw.strip(), e)
+            if cl.socket not in self.clients:
+                return
+        if not connected:
+            log_limited("close", logging.INFO, "Client %s disconnected", cl.address)
+            self.close_client(cl)
+
+    def client_writable(self, cl):
+        try:
+            # drain as much as the socket accepts, and stop watching once the queue is empty
+            sent = cl.send_pending()
+            if debug_enabled():
+                logging.debug("--> to %s: %d bytes, %d queued", cl.address, sent, len(cl.outq))
+        except OSError as e:
+            log_limited("close", logging.INFO, "Closing client %s: %s", cl.address, e)
+            self.close_client(cl)
+            return
+        if not cl.outq:
+            self.loop.remove_writer(cl.socket.fileno())
+
+    def close_client(self, cl):
+        if self.clients.pop(cl.socket, None):
+            if self.trace:
+                self.trace.add("close", cl.address)
+            fd = cl.socket.fileno()
+            self.loop.remove_reader(fd)
+            self.loop.remove_writer(fd)
+            try:
+                cl.socket.close()
+            except Exception as e:
+                logging.debug(e)
+            if cl.watch.nmea:
+                self.update_upstream_watch()
+
+    def evict_client(self, cl, reason):
+        """Disconnect a client that cannot keep up, so it does not hold up everyone else"""
+        if cl.evicted:
+            return
+        cl.evicted = reason
+        self.evictions += 1
+        if self.trace:
+            self.trace.add("evict", cl.address, reason)
+        log_limited("evict", logging.WARNING, "Evicting client %s: %s (%d queued, %d dropped, %d bytes sent)",
+                    cl.address, reason, len(cl.outq), cl.dropped, cl.bytes_sent)
+        self.close_client(cl)
+
+    def dump_trace(self):
+        if self.trace:
+            self.trace.dump()
+        else:
+            logging.warning("No trace to dump, start with --trace N to keep the last N events")
+        logging.warning("stats: %s", json.dumps(self.stats_report()))
+
+    def check_stalled(self):
+        """Evict clients whose sockets stopped taking data, even if nothing new is queued
+        for them. Runs again when the next queued client could stall out"""
+        wait = None
+        for cl in [cl for cl in self.clients.values() if cl.outq]:
+            reason = cl.overloaded()
+            if reason:
+                self.evict_client(cl, reason)
+            elif self.max_latency:
+                left = self.max_latency - cl.stalled_for()
+                wait = left if wait is None else min(wait, left)
+        return max(wait, 0.1) if wait is not None else None
+
+    #
+    # timers
+    #
+    def heartbeat(self):
+        """Send the last TPV to watching clients that have had nothing for max_period,
+        so they hear from us even when gpsd is quiet. Returns when to check again"""
+        now = time.time()
+        last = self.degraded_tpv or self.messages_archive.get('TPV')
+        wait = self.pacer.max_period
+        if not last:
+            return wait
+        sent_global = False
+        due = []
+        for cl in self.watching_clients():
+            sub = cl.watch
+            if not sub.wants(last):
+                continue
+            if sub.pacer:
+                if not sub.pacer.max_period:
+                    continue
+                left = sub.last_tpv_time + sub.pacer.max_period - now
+                if left <= 0:
+                    sub.sent_tpv(last.fields, now)
+                    due.append(cl)
+                    left = sub.pacer.max_period
+                wait = min(wait, left)
+            else:
+                left = self.last_tpv_send + self.pacer.max_period - now
+                if left <= 0:
+                    due.append(cl)
+                    sent_global = True
+                else:
+                    wait = min(wait, left)
+        if sent_global:
+            self.last_tpv_send = now
+        if due:
+            logging.info("Heartbeat TPV mode %s to %d clients", last.fields.get('mode'), len(due))
+            self.fan_out(due, last.line, 'TPV')
+        return max(wait, 0.1)
+
+    def check_upstreams(self):
+        """Fail over when the active upstream stops sending TPVs. Runs when it would go stale"""
+        self.select_upstream()
+        if self.active and self.active.writer:
+            return max(self.active.last_tpv + self.stale_after - time.monotonic(), 0.1)
+        return self.stale_after
+
+    def queue_message_for(self, target, msg, m_class=None):
+        if isinstance(target, PWN_GPSD_Proxy):
+            logging.debug("Queueing to gpsd %s: '%s'", target.name, msg.strip())
+            if target.writer:
+                target.write(msg if msg.endswith("\n") else msg + "\n")
+            return
+        self.fan_out((target,), msg, m_class)
+
+    def fan_out(self, clients, msg, m_class=None):
+        """Queue one message to many clients. It is encoded once and every queue shares the bytes"""
+        if isinstance(msg, str):
+            msg = msg.encode()
+        if not msg.endswith(b"\n"):
+            msg += b"\n"
+        n = 0
+        for cl in clients:
+            if cl.evicted:
+                continue
+            if cl.queue(msg, m_class):
+                self.loop.add_writer(cl.socket.fileno(), self.client_writable, cl)
+                if self.max_latency:
+                    self.timers.sooner("stalled", self.max_latency, self.check_stalled)
+            n += 1
+            reason = cl.overloaded()
+            if reason:
+                self.evict_client(cl, reason)
+        if n and self.trace:
+            self.trace.add("out", m_class, n)
+        if n and debug_enabled():
+            logging.debug("Queued %s to %d clients: '%s'", m_class, n, msg.strip())
+        return n
+
+    def watching_clients(self):
+        return [cl for cl in self.clients.values() if cl.watch.enable]
+
+    def poll_response(self):
+        """The ?POLL reply. The tpv and sky part is spliced from the archived lines, and only
+        rebuilt when they change, so answering is a time stamp and a join"""
+        tpv = self.messages_archive.get('TPV')
+        sky = self.messages_archive.get('SKY')
+        if not self.poll_cache or self.poll_cache[0] is not tpv or self.poll_cache[1] is not sky:
+            parts = []
+            if tpv:
+                parts.append(b'"tpv":[' + tpv.line.rstrip() + b']')
+            if sky:
+                parts.append(b'"sky":[' + sky.line.rstrip() + b']')
+            self.poll_cache = (tpv, sky, b"".join(b"," + part for part in parts) + b"}\n")
+        now = time.time()
+        stamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(now)) + ".%03dZ" % (int(now * 1000) % 1000)
+        return b'{"class":"POLL","time":"%s","active":%d%s' % (stamp.encode(), 1 if self.upstream_connected() else 0,
+                                                                self.poll_cache[2])
+
+    def upstream_watch(self):
+        """The WATCH to send gpsd, asking for NMEA only while a client wants it"""
+        self.upstream_nmea = any(cl.watch.enable and cl.watch.nmea for cl in self.clients.values())
+        return '?WATCH={"enable":true,"json":true%s};\n' % (',"nmea":true' if self.upstream_nmea else "")
+
+    def update_upstream_watch(self):
+        wants_nmea = any(cl.watch.enable and cl.watch.nmea for cl in self.clients.values())
+        if wants_nmea != self.upstream_nmea:
+            watch = self.upstream_watch()
+            for src in self.upstreams:
+                self.queue_message_for(src, watch)
+
+    def handle_client_command(self, cl, raw):
+        if self.trace:
+            self.trace.add("cmd", cl.address, raw)
+        if '=' in raw[1:]:
+            (cmd, data) = raw[1:].strip().split('=',1)
+        else:
+            cmd = raw[1:].strip().split(';',1)[0]
+            data = "{}"
+        if debug_enabled():
+            logging.debug("Client %s command %s: %s", cl.address, cmd, data.strip())
+        if cmd == "WATCH":
+            try:
+                jdata = json.loads(data.strip().strip(';'))
+                if jdata.get("enable", False):
+                    log_limited("watch", logging.INFO, "Client %s watch: %s", cl.address, data.strip())
+                    cl.watch = PWN_Subscription(jdata, self.pacer, self.sky_period)
+                    now = time.time()
+                    for upd in [ "TPV", "SKY" ]:
+                        msg = self.messages_archive.get(upd)
+                        if upd == "TPV" and self.degraded_tpv:
+                            msg = self.degraded_tpv
+                        if msg and cl.watch.wants(msg):
+                            self.queue_message_for(cl, msg.line, upd)
+                            if upd == "TPV":
+                                cl.watch.sent_tpv(msg.fields, now)
+                            else:
+                                cl.watch.sent_sky(msg.sky, now)
+                else:
+                    cl.watch = PWN_Subscription()
+                self.update_upstream_watch()
+            except Exception as e:
+                logging.exception("JDATA: %s", e)
+        elif cmd == "DEVICES":
+            try:
+                if 'DEVICES' in self.messages_archive:
+                    self.queue_message_for(cl, self.messages_archive['DEVICES'].line)
+            except Exception as e:
+                logging.exception(e)
+        elif cmd == "STATS":
+            self.queue_message_for(cl, json.dumps(self.stats_report()))
+        elif cmd == "POLL":
+            try:
+                self.queue_message_for(cl, self.poll_response(), "POLL")
+            except Exception as e:
+                logging.exception(e)
+        else:
+            log_limited("command", logging.INFO, "Forwarding %s to gpsd: %s", cmd, data.strip())
+            if self.active and self.active.writer:
+                self.queue_message_for(self.active, raw)
+
+    #
+    # gpsd upstream
+    #
+    async def read_gpsd(self, src):
+        """Read one gpsd forever, reconnecting when it goes away. Clients stay connected meanwhile"""
+        while True:
+            try:
+                await src.reconnect()
+                while True:
+                    raw = await src.read()
+                    if not raw:
+                        logging.warning("gpsd %s closed the connection", src.name)
+                        break
+                    if self.trace:
+                        self.trace.add("gpsd", src.name, raw)
+                    if self.capture:
+                        # buffered, so this rarely touches the disk
+                        self.capture.write(b"%.3f %s" % (time.time(), raw))
+                    t0 = time.perf_counter()
+                    self.handle_gpsd_message(raw, src)
+                    self.stats.handle.add(time.perf_counter() - t0)
+                    if self.keep_going > 0:
+                        self.keep_going -= 1
+                        if self.keep_going == 0:
+                            self.stop()
+                            return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error("gpsd %s: %s", src.name, e)
+            src.close()
+            src.failures += 1
+            self.select_upstream()
+            if not self.upstream_connected():
+                self.upstream_lost()
+
+    def upstream_connected(self):
+        return any(src.writer for src in self.upstreams)
+
+    def select_upstream(self):
+        """Switch to the upstream with the best fresh fix, if it beats the one in use"""
+        if len(self.upstreams) < 2:
+            return
+        best = max(self.upstreams, key=lambda src: src.rank(self.stale_after))
+        if best is not self.active and best.rank(self.stale_after) > self.active.rank(self.stale_after):
+            logging.warning("Switching upstream from %s (mode %s) to %s (mode %s, eph %s)", self.active.name, self.active.mode,
+                            best.name, best.mode, best.eph)
+            if self.trace:
+                self.trace.add("switch", self.active.name, best.name)
+            self.active = best
+
+    def upstream_lost(self):
+        """Tell watching clients the fix is stale: the last TPV again, with mode 1 (no fix)"""
+        last = self.messages_archive.get('TPV')
+        if not last or self.degraded_tpv:
+            return
+        try:
+            data = dict(last.data)
+            data['mode'] = min(data.get('mode', 1), 1)
+            self.degraded_tpv = PWN_GPSMessage(json.dumps(data), data)
+            self.fan_out((cl for cl in self.watching_clients() if cl.watch.wants(self.degraded_tpv)),
+                         self.degraded_tpv.line, 'TPV')
+        except Exception as e:
+            logging.exception("Degraded TPV: %s", e)
+
+    def handle_gpsd_message(self, line, src=None):
+        if debug_enabled():
+            logging.debug("Got %s", line.strip())
+        src = src or self.active
+        if line[:1] in (b"$", b"!"):
+            self.stats.count_line("NMEA")
+            if src is not self.active:
+                return
+            # NMEA sentence, only there while a client asked for it
+            self.fan_out((cl for cl in self.watching_clients() if cl.watch.nmea), line, "NMEA")
+            return
+        msg = PWN_GPSMessage(line)
+        m_class = msg.m_class
+        try:
+            if not m_class:
+                m_class = msg.data.get('class', None)
+        except Exception as e:
+            log_limited("bad json", logging.WARNING, "Bad JSON: '%s': %s", line, e)
+            return
+        self.stats.count_line(m_class)
+        if m_class == 'TPV' and src:
+            src.note_tpv(msg.fields)
+            self.select_upstream()
+        if src is not self.active and m_class != 'VERSION':
+            # only the upstream in use feeds the clients
+            return
+        if m_class == 'VERSION':
+            # newly connected, so start the watch
+            logging.info("Sending Watch and Devices requests to %s", src.name)
+            self.queue_message_for(src, self.upstream_watch())
+        elif m_class == 'WATCH':
+            logging.info("WATCH")
+            for k, v in msg.data.items():
+                if k == "class":
+                    continue
+                logging.info("\t%s = %s", k, v)
+        elif m_class == 'DEVICE':
+            logging.debug("GPSD> %s", line.strip())
+            self.fan_out((cl for cl in self.watching_clients() if cl.watch.wants(msg)), msg.line)
+        elif m_class == 'DEVICES':
+            logging.info("gpsd devices: %s", ", ".join(d.get('path', '?') for d in msg.data.get('devices', [])))
+        elif m_class == 'TPV': # position update
+            if self.degraded_tpv:
+                # the first fix since gpsd went away. Clients last saw the mode 1 copy,
+                # so compare with that, or the same position would count as a repeat
+                self.messages_archive["LAST_SENT_TPV"] = self.degraded_tpv
+                self.degraded_tpv = None
+            if not self.handle_tpv(msg):
+                return
+        elif m_class == 'PPS': # pps time
+            pass
+        elif m_class == 'SKY': # sats
+            if debug_enabled():
+                # guarded, as listing the satellites needs the SKY decoded
+                logging.debug("%d satellites visible:", msg.data.get('nSat', 0))
+                for sat in msg.data.get('satellites', []):
+                    logging.debug("\t%s\t%0.0f\t%0.0f\t%s", sat.get('PRN', 0), sat.get('el', 0),
+                                  sat.get('az', 0), "+" if sat.get('used', False) else "")
+            # on each client's SKY schedule, or sooner if the satellites in use changed
+            now = time.time()
+            sky = msg.sky
+            self.fan_out((cl for cl in self.watching_clients() if cl.watch.wants(msg) and cl.watch.sky_due(sky, now)),
+                         msg.line, m_class)
+        else:
+            log_limited("unknown", logging.INFO, "Unknown message type: %s", line.strip())
+        # store latest message of each type
+        if m_class == 'TPV':
+            last = self.messages_archive.get(m_class)
+            if not last:
+                self.messages_archive[m_class] = msg
+            elif msg.get('mode',0) >= last.get('mode',0) and line != last.line:
+                self.messages_archive[m_class] = msg
+        else:
+            self.messages_archive[m_class] = msg
+
+    def handle_tpv(self, msg):
+        """Pace TPV updates to clients. Returns False if the message should not be archived"""
+        m_class = 'TPV'
+        tpv = msg.fields
+        last_sent = self.messages_archive.get("LAST_SENT_" + m_class)
+        last_tpv = last_sent.fields if last_sent else {}
+        if last_tpv.keys() == tpv.keys() and all(v == last_tpv[k] for k, v in tpv.items() if k != "time"):
+            # same position, so skip it
+            self.stats.tpv['repeat'] += 1
+            if self.trace:
+                self.trace.add("tpv", "repeat")
+            return True
+
+        mode = tpv.get('mode', -1)
+        elapsed = time.time() - self.last_tpv_send
+
+        if mode == 3 and 'alt' not in tpv and 'altMSL' not in tpv and 'alt' in last_tpv:
+            # last one had alt, this is mode 3 and should have alt, so
+            # skip it and wait for TPV with alt
+            self.stats.tpv['no_alt'] += 1
+            if self.trace:
+                self.trace.add("tpv", "no alt")
+            return False
+
+        reason = self.pacer.check(tpv, last_tpv, elapsed)
+        propagate = reason is not None
+        self.stats.tpv['sent' if propagate else 'paced'] += 1
+        if self.trace:
+            self.trace.add("tpv", reason or "paced", "%0.1fs" % elapsed)
+        if reason == "max period":
+            # minimum update interval
+            logging.info("Min time update mode %s %0.4f, %0.4f, %0.2f", mode,
+                         tpv.get('lat', 0), tpv.get('lon', 0), tpv.get('alt', 0))
+        elif propagate:
+            logging.info("Update for %s: %0.6f, %0.6f, %0.2f", reason,
+                         tpv.get('lat', 0), tpv.get('lon', 0), tpv.get('alt', 0))
+            raw = msg.raw
+            self.queue_track("pwntrack_%Y%m%d.txt", raw, raw.strip() + ",\n", tpv)
+
+        now = time.time()
+        last = self.messages_archive.get(m_class)
+        out = last if last and last.get('identity') else msg
+        if propagate:
+            self.last_tpv_send = now
+            self.messages_archive["LAST_SENT_%s" % m_class] = msg
+
+        # share with proxy clients, on the proxy's pacing or their own
+        def due(cl):
+            sub = cl.watch
+            if not sub.wants(msg):
+                return False
+            if not sub.pacer:
+                return propagate
+            if sub.tpv_due(tpv, now):
+                sub.sent_tpv(tpv, now)
+                return True
+            return False
+        self.fan_out(filter(due, self.watching_clients()), out.line, m_class)
+
+        # update peering information
+        if propagate and self.advert_publisher:
+            self.advert_publisher.offer(msg.raw, tpv)
+        return True
+
+    #
+    # configuration
+    #
+    def current_settings(self):
+        """The reloadable settings as they are now, keyed like CONFIG_KEYS"""
+        p = self.pacer
+        return {'min_period': p.min_period, 'decimals': self.ll_decimals, 'alt_precision': p.min_alt,
+                'min_distance': self.min_distance, 'max_period': p.max_period, 'speed_factor': p.speed_factor,
+                'sky_period': self.sky_period,
+                'share': self.shareWPeers, 'use_shared': self.useSharedLoc, 'password': self.gpsd.password,
+                'share_period': self.share_period, 'share_distance': self.share_distance,
+                'share_max_period': self.share_max_period,
+                'pwngrid_timeout': self.pwngrid_timeout,
+                'log_level': logging.root.level, 'stats_interval': self.stats_interval,
+                'trace': self.trace.events.maxlen if self.trace else 0}
+
+    def reload_config(self):
+        """SIGHUP: read the config file again. A file that does not load changes nothing"""
+        if not self.config_path:
+            logging.warning("No config file to reload, start with --config FILE")
+            return
+        try:
+            self.apply_config(load_config(self.config_path))
+        except Exception as e:
+            logging.error("Not reloading %s: %s", self.config_path, e)
+
+    def apply_config(self, conf):
+        """Apply config file settings over the command line ones. Clients stay connected,
+        and settings missing from the file go back to their command line values"""
+        s = dict(self.cli_settings, **conf)
+        if s['share'] or s['use_shared']:
+            # fails before anything has changed
+            self.check_sharing(s['password'])
+        old = self.current_settings()
+
+        self.min_period = s['min_period']
+        self.ll_decimals = s['decimals']
+        self.alt_min_chg = s['alt_precision']
+        self.min_distance = s['min_distance']
+        self.pacer = PWN_Pacer(PWN_Pacer.decimals_to_m(self.ll_decimals) if self.min_distance is None else self.min_distance,
+                               self.alt_min_chg, self.min_period, s['max_period'], s['speed_factor'])
+        self.sky_period = s['sky_period']
+        for cl in self.clients.values():
+            cl.watch.set_defaults(self.pacer, self.sky_period)
+
+        logging.root.setLevel(s['log_level'])
+        self.stats_interval = s['stats_interval']
+        if not s['trace']:
+            self.trace = None
+        elif not self.trace or self.trace.events.maxlen != s['trace']:
+            trace = PWN_Trace(s['trace'])
+            if self.trace:
+                trace.events.extend(self.trace.events)
+            self.trace = trace
+
+        if self.timers:
+            if not self.pacer.max_period:
+                self.timers.cancel("heartbeat")
+            elif self.pacer.max_period != old['max_period'] or self.timers.due_in("heartbeat") is None:
+                self.timers.schedule("heartbeat", self.pacer.max_period, self.heartbeat)
+            if not self.stats_interval:
+                self.timers.cancel("stats")
+            elif self.stats_interval != old['stats_interval'] or self.timers.due_in("stats") is None:
+                self.timers.schedule("stats", self.stats_interval, self.log_stats)
+
+        sharing = ('share', 'use_shared', 'password', 'share_period', 'share_distance', 'share_max_period',
+                   'pwngrid_timeout')
+        if any(s[k] != old[k] for k in sharing):
+            self.apply_sharing(s)
+        shown = dict(s, password="***", log_level=logging.getLevelName(s['log_level']))
+        changed = ["%s=%s" % (k, shown[k]) for k in sorted(s) if s[k] != old[k]]
+        logging.info("Config %s: %s", self.config_path, ", ".join(changed) if changed else "no changes")
+
+    #
+    # pwngrid
+    #
+    ADVERT_REFRESH = 60   # seconds before the cached advertisement is fetched again
+
+    def check_sharing(self, password):
+        """Load what location sharing needs, raising ValueError if it can't be done"""
+        global pwngrid
+        if not pwnshare:
+            raise ValueError("Sharing locations needs pwnshare.py installed next to pwn-gpsd.py")
+        # build the Fernet now, so missing cryptography shows up at startup or reload
+        pwnshare.fernet_for(password)
+        pwngrid = pwngrid or importlib.import_module("pwnagotchi.grid")
+
+    def new_publisher(self):
+        gen = self.share_gen
+        return PWN_AdvertPublisher(lambda raw: self._set_advertisement(raw, gen), self.share_period,
+                                   self.share_distance, self.pwngrid_timeout, self.share_max_period)
+
+    def start_sharing(self):
+        self.sharing_tasks = []
+        if self.peer_poller:
+            self.sharing_tasks.append(asyncio.create_task(self.peer_poller.run(self.update_from_friends),
+                                                          name="pwngrid poller"))
+        if self.advert_publisher:
+            self.sharing_tasks.append(asyncio.create_task(self.advert_publisher.run(), name="pwngrid publisher"))
+
+    def apply_sharing(self, s):
+        """Switch to new sharing settings in one step. The password (and so the Fernet) of every
+        upstream changes together, and a new generation makes threads still working on the
+        old advertisement drop it. The first update under the new one fetches it fresh"""
+        was_sharing = self.shareWPeers
+        for src in set(self.upstreams + [self.gpsd]):
+            src.password = s['password']
+        self.shareWPeers = s['share']
+        self.useSharedLoc = s['use_shared']
+        self.wantPwngrid = self.shareWPeers or self.useSharedLoc
+        self.share_period = s['share_period']
+        self.share_distance = s['share_distance']
+        self.share_max_period = s['share_max_period']
+        self.pwngrid_timeout = s['pwngrid_timeout']
+        self.share_gen += 1
+
+        for t in self.sharing_tasks:
+            t.cancel()
+        self.peer_poller = PWN_PeerPoller(self._poll_pwngrid, timeout=self.pwngrid_timeout) if self.useSharedLoc else None
+        self.advert_publisher = self.new_publisher() if self.shareWPeers else None
+        if not self.loop:
+            return
+        self.start_sharing()
+        last = self.messages_archive.get("LAST_SENT_TPV")
+        if self.advert_publisher and last:
+            # readvertise under the new key without waiting for a move
+            self.advert_publisher.offer(last.raw, last.fields)
+        elif was_sharing and not self.shareWPeers:
+            self.sharing_tasks.append(asyncio.create_task(self.clear_advertisement(self.share_gen),
+                                                          name="pwngrid clear"))
+
+    def _advertise(self):
+        if not self.pwngridAdvertising:
+            logging.info("Activating pwngrid advertising")
+            pwngrid.advertise(True)
+            self.pwngridAdvertising = True
+
+    def _set_advertisement(self, raw, gen):
+        """Put our encrypted location in the pwngrid advertisement. Runs in the publisher thread.
+
+        gen is the share_gen the publisher was made under. An update left over
+        from before a reload is dropped, so the old key never overwrites the new"""
+        with self.advert_lock:
+            if gen != self.share_gen:
+                return
+            if self.advert_gen != gen:
+                self.advert = None
+                self.advert_gen = gen
+            try:
+                self._advertise()
+                # reuse the advertisement, but pick up what pwnagotchi changed in it now and then
+                if self.advert is None or time.time() - self.advert_time > self.ADVERT_REFRESH:
+                    self.advert = pwngrid.get_advertisement_data()
+                    self.advert_time = time.time()
+                self.advert['snorlax'] = self.gpsd.encrypt_data(raw)
+                pwngrid.set_advertisement_data(self.advert)
+            except Exception as e:
+                self.pwngridAdvertising = False
+                self.advert = None
+                raise
+
+    async def clear_advertisement(self, gen):
+        """Run _clear_advertisement in its own thread, like the publisher, so a hung
+        pwngrid-peer never holds up the executor the track writes use"""
+        try:
+            await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(
+                start_thread(self._clear_advertisement, gen, name="pwngrid clear"))), self.pwngrid_timeout)
+        except (TimeoutError, asyncio.TimeoutError) as e:
+            logging.warning("Clearing the pwngrid advertisement timed out after %ss", self.pwngrid_timeout)
+
+    def _clear_advertisement(self, gen):
+        """Take our location out of the pwngrid advertisement once sharing is turned off"""
+        with self.advert_lock:
+            if gen != self.share_gen:
+                return
+            try:
+                advert = pwngrid.get_advertisement_data()
+                if advert.pop('snorlax', None) is not None:
+                    pwngrid.set_advertisement_data(advert)
+                logging.info("Stopped sharing location on pwngrid")
+            except Exception as e:
+                logging.error("Could not clear pwngrid advertisement: %s", e)
+            self.advert = None
 
-keepGoing = -1
+    def _friend_locations(self):
+        """Fetch pwngrid peers and decrypt their shared locations"""
+        friend_locs = []
+        peers = pwngrid.peers()
+
+        for p in peers:
+            adv = p.get('advertisement', {})
+            try:
+                p_loc = self.gpsd.decrypt_location(adv.get('snorlax'))
+                if p_loc:
+                    logging.debug("Peer %s pos: %s", adv.get('name', ""), p_loc)
+                    p_loc['name'] = adv['name']
+                    p_loc['identity'] = adv['identity']
+                    p_loc['Cached'] = time.time()
+                    p_loc['rssi'] = p.get('rssi', None)
+                    friend_locs.append(p_loc)
+            except Exception as e:
+                log_limited("peer location", logging.INFO, "Could not read location from %s: %s", adv.get('name'), e)
+        return friend_locs
+
+    def _poll_pwngrid(self):
+        """Make sure we are advertising, then fetch friend locations. Runs in the poller thread"""
+        try:
+            self._advertise()
+            return self._friend_locations()
+        except Exception as e:
+            self.pwngridAdvertising = False
+            raise
 
-class PWN_GPSD(plugins.Plugin):
+    def update_from_friends(self, friend_locs):
+        # average locations for "my location"
+        last_tpv = self.messages_archive['TPV'].data if 'TPV' in self.messages_archive else {}
+        new_tpv = copy.deepcopy(friend_locs[0])
+        new_tpv['name'] = "me"
+        new_tpv['lat'] = 0
+        new_tpv['lon'] = 0
+        new_tpv['alt'] = 0
+        new_tpv['rssi'] = 0
+        new_tpv['mode'] = 0
+        count = 0
+        altweight = 0
+        friends = 0
+        for f in friend_locs:
+            logging.debug("Friend mode %s", f.get('mode'))
+            if f.get('mode', -2) > new_tpv.get('mode', 0):
+                new_tpv['mode'] = f.get('mode')
+                logging.debug("Picking mode from %s", f)
+            rssi = f.get('rssi', -198)
+            mode = f.get('mode', -1)
+            if f.get('time', '0000-00-00') > new_tpv.get('time', '1111-11-11'):
+                new_tpv['time'] = f.get('time')
+            if mode > 1:
+                weight = int(100+(rssi if rssi > -200 else -198)/2)
+                new_tpv['lat'] = new_tpv.get('lat', 0) + f.get('lat') * weight
+                new_tpv['lon'] = new_tpv.get('lon', 0) + f.get('lon') * weight
+                new_tpv['rssi'] = new_tpv.get('rssi', 0) + rssi * weight
+                if 'alt' in f:
+                    new_tpv['alt'] = new_tpv.get('alt', 0) + f.get('alt') * weight
+                    altweight += weight
+                count += weight
+                friends+=1
+                logging.debug("Running totals: %s %s", new_tpv['lon'], new_tpv['lat'])
+        if friends > 0:
+            if count:
+                logging.debug("Before Div 2: %s", new_tpv['lat'] / count)
+                new_tpv['lat'] /= count
+                new_tpv['lon'] /= count
+                new_tpv['rssi'] /= count
+                if altweight > 0:
+                    new_tpv['alt'] /= altweight
+                new_tpv['undivided_count'] = (friends,count)
+                logging.debug("DIVIDED: %d, %d %s", friends, count, new_tpv)
+                logging.info("->Me %s\t%s,%s\t%s\t%s", new_tpv['name'], new_tpv['lon'], new_tpv['lat'], new_tpv['rssi'], new_tpv.get("time", ""))
+
+            if new_tpv.get('mode', -1) >= last_tpv.get('mode', 0):
+                # archiving
+                logging.info("Updating cache from %d friends %s", friends, new_tpv)
+                self.messages_archive['TPV'] = PWN_GPSMessage(json.dumps(new_tpv), new_tpv)
+            if new_tpv.get('mode', -1) >= 2:
+                c_check = "%s %s %s" % (new_tpv.get('time', '00'),
+                                        new_tpv.get('lat', 69),
+                                        new_tpv.get('lon', 420))
+                if self.last_share_compare != c_check: # do not write the same loc twice
+                    self.last_share_compare = c_check
+                    logging.debug("CURRENT: %s", new_tpv)
+                    self.queue_track("peertrack_%Y%m%d.txt",
+                                     json.dumps(new_tpv), json.dumps(new_tpv) + "\n", new_tpv)
+
+    #
+    # track logs
+    #
+    def queue_track(self, fname_fmt, current, line, tpv=None):
+        """Save current location and append to the daily track on the next flush"""
+        self.track_lines.extend(self.tracks.entries(fname_fmt, line, tpv))
+        self.track_current = current
+        if self.timers:
+            self.timers.sooner("tracks", max(self.tracks.flush_interval, 1), self.start_flush)
+
+    def start_flush(self):
+        """Timer job: write the batched track lines in the background"""
+        if self.flush_task and not self.flush_task.done():
+            return 1
+        self.flush_task = self.loop.create_task(self.flush_tracks())
+
+    async def flush_tracks(self):
+        if self.track_lines or self.track_current is not None:
+            (lines, current) = (self.track_lines, self.track_current)
+            self.track_lines = []
+            self.track_current = None
+            try:
+                t0 = time.perf_counter()
+                await self.run_blocking(self.tracks.write, lines, current)
+                self.stats.track_write.add(time.perf_counter() - t0)
+            except Exception as e:
+                logging.exception("Saving current location: %s", e)
+
+    #
+    # metrics
+    #
+    def stats_report(self):
+        """Everything ?STATS reports, as a dict"""
+        st = self.stats
+        report = {'class': "STATS",
+                  'uptime': round(time.time() - st.started, 1),
+                  'lines': st.lines,
+                  'tpv': st.tpv,
+                  'evictions': self.evictions,
+                  'handle_ms': st.handle.summary(),
+                  'loop_lag_ms': st.loop_lag.summary(),
+                  'track_write_ms': st.track_write.summary(),
+                  'upstreams': [{'name': src.name, 'connected': src.writer is not None, 'active': src is self.active,
+                                 'mode': src.mode, 'eph': src.eph} for src in self.upstreams],
+                  'clients': [{'address': "%s:%s" % tuple(cl.address[:2]) if isinstance(cl.address, tuple) else str(cl.address),
+                               'watch': cl.watch.enable, 'queued': len(cl.outq), 'queued_bytes': cl.out_bytes,
+                               'sent_bytes': cl.bytes_sent, 'dropped': cl.dropped} for cl in self.clients.values()]}
+        if self.peer_poller:
+            report['pwngrid_poll'] = self.peer_poller.stats()
+        if self.advert_publisher:
+            report['pwngrid_publish'] = self.advert_publisher.stats()
+        return report
+
+    def log_stats(self):
+        """One INFO line every stats_interval seconds. A failure is logged, and the job kept"""
+        try:
+            self.log_stats_summary()
+        except Exception as e:
+            logging.exception("stats: %s", e)
+        return self.stats_interval
+
+    def log_stats_summary(self):
+        st = self.stats
+        rates = st.rates()
+        tpv = st.tpv
+        seen = sum(tpv.values())
+        summary = "%0.1f lines/s (%s), TPV sent %d/%d, %d clients, %d bytes queued, %d evicted, handle p99 %sms, loop lag max %sms, track write max %sms" % (
+            sum(rates.values()), ", ".join("%s %s" % kv for kv in sorted(rates.items())),
+            tpv['sent'], seen, len(self.clients), sum(cl.out_bytes for cl in self.clients.values()), self.evictions,
+            st.handle.summary()['p99'], st.loop_lag.summary()['max'], st.track_write.summary()['max'])
+        if self.peer_poller:
+            summary += ", pwngrid poll mean %ss" % (self.peer_poller.stats()['latency_mean'])
+        logging.info("stats: %s", summary)
+
+if __name__ != "__main__":
+    # loaded as a pwnagotchi plugin. The proxy daemon does not need any of this
+    from statistics import mean
+    import urllib
+    import urllib.error
+    import urllib.parse
+    import urllib.request
+
+    import pwnagotchi.plugins as plugins
+    from pwnagotchi.ui.components import LabeledValue
+    import pwnagotchi.ui.fonts as fonts
+    PluginBase = plugins.Plugin
+else:
+    PluginBase = object
+
+class PWN_GPSD(PluginBase):
     __author__ = 'Sniffleupagus'
     __version__ = '1.0.0'
     __license__ = 'GPL3'
@@ -193,7 +2081,7 @@ class PWN_GPSD(plugins.Plugin):
     def on_loaded(self):
         logging.debug("PWN-GPS loaded! options = %s " % repr(self.options))
         #if 'wigle_api_key' not in self.options:
-        #    logging.warn("No Wigle API Key specified. An API key is needed to request data from Wigle. See https://api.wigle.net for more information, and put the 'Encoded for use' key in config.toml as main.plugins.pwn_gpsd.wigle_api_key")
+        #    logging.warning("No Wigle API Key specified. An API key is needed to request data from Wigle. See https://api.wigle.net for more information, and put the 'Encoded for use' key in config.toml as main.plugins.pwn_gpsd.wigle_api_key")
 
     # called before the plugin is unloaded
     def on_unload(self, ui):
@@ -289,7 +2177,7 @@ class PWN_GPSD(plugins.Plugin):
                         try:
                             gps_data = json.load(f)
                         except Exception as e:
-                            logging.warn(e)
+                            logging.warning(e)
                             break
                     lats.append(gps_data['Latitude'])
                     longs.append(gps_data['Longitude'])
@@ -481,57 +2369,92 @@ class PWN_GPSD(plugins.Plugin):
 # with minimum interval between updates, and minimum movement between updates
 #
 if __name__ == "__main__":
-#    from pwnagotchi import log
-    from pwnagotchi import utils
-
     formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] (%(filename)s:%(lineno)d) %(funcName)s: %(message)s")
-    #formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] (%(filename)s:%(lineno)d) %(funcName)s: %(message)s")
     logger = logging.getLogger()
     logger.setLevel(logging.INFO)
     root = logging.getLogger()
+    if not root.handlers:
+        # the pwnagotchi imports used to set this up
+        logging.basicConfig()
     root.handlers[0].setFormatter(formatter)
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(formatter)
     #logger.addHandler(console_handler)
 
-    
-    class FakeArgs:
-        def __init__(self, debug=False):
-            self.debug = debug
-    
-   # fake_args = FakeArgs()
-   # fake_config = {'main':{'log':{'path':"/tmp/magic.out",
-   #                               'console':False,
-   #                               'path-debug':"/tmp/magic.err",
-   #                               'rotation':{'enabled':False}}}}
-    #log.setup_logging(fake_args, fake_config)
-
     try:
-    
-        opts, args = getopt.getopt(sys.argv[1:], "SUNP:s:k:p:m:d:a:q")
+        opts, args = getopt.getopt(sys.argv[1:], "SUNP:s:k:p:m:d:a:qQ:",
+                                   ["share", "use-shared", "no-gpsd", "password=", "server=", "kount=",
+                                    "port=", "min-period=", "decimals=", "alt-precision=", "quiet", "max-queue=",
+                                    "high-water=", "max-latency=", "pwngrid-timeout=",
+                                    "share-period=", "share-distance=", "share-max-period=",
+                                    "min-distance=", "max-period=", "speed-factor=", "sky-period=",
+                                    "reconnect-max=", "stale-after=", "stats-interval=", "capture=", "trace=", "config=",
+                                    "track-flush=", "track-fsync=", "track-format=", "track-dir="])
     except getopt.GetoptError as err:
         logging.exception(err)
         sys.exit(2)
         
-    server = "127.0.0.1:2947"   # GPSD server to connect to
+    servers = []                # GPSD servers to connect to, host:port[@priority]
+    use_gpsd = True
     proxy_port = 7492           # local port for proxy server
     min_period = 10             # minimum seconds between updates
     ll_decimals = 4             # decimal points precision in lat/long for min update change
     alt_min_chg = 1             # meters delta between updates
+    min_distance = None         # meters moved between updates, from ll_decimals if not set
+    max_period = 60             # seconds before an update is sent even without moving
+    speed_factor = 0            # seconds of travel at current speed before an update, 0 for off
+    sky_period = 4              # seconds between SKY reports to each client
+    reconnect_max = 60          # longest wait between gpsd reconnect attempts
+    stale_after = 5             # seconds without a TPV before failing over to another gpsd
+    stats_interval = 300        # seconds between stats summaries in the log, 0 for none
+    capture = None              # file to record raw gpsd lines in, for gpsreplay.py
+    trace = 0                   # recent events to keep for SIGUSR1, 0 for none
+    config = None               # TOML or JSON file with settings to reload on SIGHUP
+    max_queue = 32              # messages queued per client before dropping old TPV/SKY
+    high_water = 65536          # unsent bytes per client before evicting it
+    max_latency = 30            # seconds a message may wait for a client before evicting it
+    track_flush = 10            # seconds between batched track log writes
+    track_fsync = 300           # seconds between track log fsyncs, 0 for never
+    track_format = "text"       # text, binary or both
+    track_dir = TRACK_DIR       # where track logs and current.txt go
+    pwngrid_timeout = 5         # seconds before a pwngrid peer poll is abandoned
+    share_period = 10           # minimum seconds between advertised location updates
+    share_distance = 10         # meters moved before the advertised location is updated
+    share_max_period = 60       # seconds before an unchanged location is advertised again
     shareWPeers = False
     useSharedLoc = False
-    pwngridAdvertising = False
-    wantPwngrid = False
     sharingPassword = "Friendship"
 
     def usage():
         print("pwn-gpsd.py [--quiet] [--port PORT] [--server hostname:port] [--min-period MP] [--decimals LL] [--alt-precision AP]\n")
         print("\tPORT = local port for gpsd proxy server, default 7492\n")
-        print("\thostname:port = gpsd to proxy, default localhost:2947\n")
-        print("\tMP = minimum time between updates in seconds, integer, default 10\n")
+        print("\thostname:port = gpsd to proxy, default localhost:2947. Repeat --server, or separate with commas, to read several gpsd at once. The one with the best fresh fix (mode, then priority, then eph) feeds the clients. Add @N to set a priority, lower is preferred, default is the order given\n")
+        print("\t--stale-after SECS = fail over from a gpsd that has sent no TPV for this long, default 5\n")
+        print("\tMP = minimum time between updates in seconds, default 10\n")
         print("\tLL = decimal point precision on Latitude and Longitude. No update until there is a change in that many decimal places. default 4.  Ex: If 4, lat = 37.2654 will not report again until move to 36.2653 or 36.2655, about 11 meters.  If 3, it won't report until 37.266 or 36.264, about 110 meters\n")
-        print("\tAP = minimum change in altitude to trigger GPS proxy update, in same units as preferred for display\n")
-        print("\npwn-gpsd executed as a program makes a lower-bandwidth proxy for gpsd. It will proxy WATCH requests, pacing the output as defined by the parameters min_period, ll_decimals, alt_min_chg. While WATCH is active, the server will process data from gpsd, and only send it to clients if min_period seconds have passed AND the location has changed by alt_min_chg height since the last update, or by a distance causing a change in the displayed latitude or longitude down to the ll_decimals decimal point.\n")            
+        print("\tAP = minimum change in altitude to trigger GPS proxy update, in meters, default 1\n")
+        print("\t--min-distance METERS = minimum horizontal move to trigger an update, overrides --decimals\n")
+        print("\t--max-period SECS = send an update at least this often, even without moving, default 60\n")
+        print("\t--speed-factor SECS = when moving fast, wait for a move of speed * SECS meters, default 0 (off)\n")
+        print("\t--max-queue N = messages queued per client before the oldest TPV/SKY is dropped, default 32\n")
+        print("\t--high-water BYTES = disconnect a client with more than this many unsent bytes, default 65536\n")
+        print("\t--max-latency SECS = disconnect a client that has not accepted data for this long, default 30\n")
+        print("\t--pwngrid-timeout SECS = give up on a pwngrid peer poll after this long and back off, default 5\n")
+        print("\t--reconnect-max SECS = when gpsd goes away, retry with backoff up to this long between attempts, default 60\n")
+        print("\t--stats-interval SECS = log a one line stats summary this often, 0 for never, default 300. Clients can send ?STATS; for the details\n")
+        print("\t--sky-period SECS = send each client a SKY report this often, default 4. Sooner when nSat or the satellites in use change, and never the same report twice in a row\n")
+        print("\tClients can ask for their own pacing with extra WATCH options, e.g. ?WATCH={\"enable\":true,\"min_period\":1,\"min_distance\":0}; with min_period, min_distance, min_alt, max_period, speed_factor and sky_period\n")
+        print("\t--share-period SECS = with -S, update the advertised location at most this often, default 10\n")
+        print("\t--share-distance METERS = with -S, only update the advertised location after moving this far, default 10\n")
+        print("\t--share-max-period SECS = with -S, advertise the location again after this long even without moving, so peers do not drop a parked unit, default 60\n")
+        print("\t--capture FILE = append every line read from gpsd to FILE, with its arrival time, to replay later with gpsreplay.py, into a proxy with a scratch --track-dir\n")
+        print("\t--trace N = keep the last N message events in memory, and log them on SIGUSR1 (kill -USR1 PID) along with ?STATS. Default 0, off\n")
+        print("\t--config FILE = read settings from a TOML (.toml) or JSON file, reread on SIGHUP (kill -HUP PID) without dropping clients. Keys are the long options with _ for -: min_period, decimals, alt_precision, min_distance, max_period, speed_factor, sky_period, share, use_shared, password, share_period, share_distance, share_max_period, pwngrid_timeout, log_level, stats_interval and trace. They override the command line, and ones left out of the file go back to the command line value\n")
+        print("\t--track-flush SECS = how often track logs and current.txt are written, default 10\n")
+        print("\t--track-fsync SECS = how often track logs are synced to disk, 0 for never, default 300\n")
+        print("\t--track-format FMT = text, binary (pwntrack.py records) or both, default text\n")
+        print("\t--track-dir DIR = where track logs and current.txt are written, and current.txt is preloaded from, default %s. Point test runs (gpsreplay.py, benchmark.py) at a scratch directory so they stay out of the real tracks\n" % TRACK_DIR)
+        print("\npwn-gpsd executed as a program makes a lower-bandwidth proxy for gpsd. It will proxy WATCH requests, pacing the output as defined by the parameters min_period, ll_decimals (or min_distance), alt_min_chg. While WATCH is active, the server will process data from gpsd, and only send it to clients if min_period seconds have passed AND the location has changed by alt_min_chg height since the last update, or moved about one unit in the ll_decimals decimal place (11 meters for 4), measured in meters so it is the same at any latitude.\n")            
     
     keepGoing = -1 # default to forever
 
@@ -540,544 +2463,91 @@ if __name__ == "__main__":
             print(" Setting port to %s" % a)
             proxy_port = int(a)
         elif o in ("-N", "--no-gpsd"):
-            server = None
+            use_gpsd = False
         elif o in ("-s", "--server"):
-            server = a
+            servers.extend(a.split(","))
         elif o in ("-k", "--kount"):
             keepGoing = int(a)
         elif o in ("-m", "--min-period"):
-            min_period = int(a)
+            min_period = float(a)
         elif o in ("-d", "--decimals"):
             ll_decimals = int(a)
         elif o in ("-a", "--alt-precision"):
-            alt_decimals = int(a)
-        elif o in ("-S", "share"):
+            alt_min_chg = float(a)
+        elif o in ("-S", "--share"):
             shareWPeers = True
-            wantPwngrid = True
-        elif o in ("-U", "use-shared"):
+        elif o in ("-U", "--use-shared"):
             useSharedLoc = True
-            wantPwngrid = True
         elif o in ("-P", "--password"):
             sharingPassword = a
         elif o in ("-q", "--quiet"):
             quiet = True
-
-    if server:
-        (host, sport) = server.split(":",1)
-        gpsd = PWN_GPSD_Proxy(host, int(sport), watch=True, password=sharingPassword)
-        gpsd_socket = gpsd.socket
-    else:
-        gpsd = PWN_GPSD_Proxy(None, 0, watch=True, password=sharingPassword)
-        gpsd_socket = None
-
-
-    # create proxy socket
-    server_socket = None
+        elif o in ("-Q", "--max-queue"):
+            max_queue = int(a)
+        elif o == "--high-water":
+            high_water = int(a)
+        elif o == "--max-latency":
+            max_latency = float(a)
+        elif o == "--pwngrid-timeout":
+            pwngrid_timeout = float(a)
+        elif o == "--share-period":
+            share_period = float(a)
+        elif o == "--share-distance":
+            share_distance = float(a)
+        elif o == "--share-max-period":
+            share_max_period = float(a)
+        elif o == "--min-distance":
+            min_distance = float(a)
+        elif o == "--max-period":
+            max_period = float(a)
+        elif o == "--speed-factor":
+            speed_factor = float(a)
+        elif o == "--reconnect-max":
+            reconnect_max = float(a)
+        elif o == "--stale-after":
+            stale_after = float(a)
+        elif o == "--stats-interval":
+            stats_interval = float(a)
+        elif o == "--trace":
+            trace = int(a)
+        elif o == "--capture":
+            capture = a
+        elif o == "--config":
+            config = a
+        elif o == "--sky-period":
+            sky_period = float(a)
+        elif o == "--track-flush":
+            track_flush = float(a)
+        elif o == "--track-fsync":
+            track_fsync = float(a)
+        elif o == "--track-format":
+            track_format = a
+        elif o == "--track-dir":
+            track_dir = a
+
+    upstreams = []
+    if use_gpsd:
+        for (i, server) in enumerate(servers or ["127.0.0.1:2947"]):
+            (server, _, prio) = server.partition("@")
+            (host, sport) = server.split(":",1)
+            upstreams.append(PWN_GPSD_Proxy(host, int(sport), watch=True, password=sharingPassword,
+                                            backoff_max=reconnect_max, priority=int(prio) if prio else i))
+    gpsd = upstreams[0] if upstreams else PWN_GPSD_Proxy(None, 0, watch=True, password=sharingPassword)
+
+    proxy = PWN_GPSD_Server(gpsd, port=proxy_port, min_period=min_period,
+                            ll_decimals=ll_decimals, alt_min_chg=alt_min_chg,
+                            share=shareWPeers, use_shared=useSharedLoc, keep_going=keepGoing,
+                            max_queue=max_queue, high_water=high_water, max_latency=max_latency,
+                            tracks=PWN_TrackWriter(track_dir, track_flush, track_fsync, track_format),
+                            pwngrid_timeout=pwngrid_timeout,
+                            share_period=share_period, share_distance=share_distance,
+                            share_max_period=share_max_period,
+                            min_distance=min_distance, max_period=max_period, speed_factor=speed_factor,
+                            sky_period=sky_period, upstreams=upstreams, stale_after=stale_after,
+                            stats_interval=stats_interval, capture=capture, trace=trace, config=config)
     try:
-        n_tries = 3
-        while n_tries and not server_socket:
-            try:
-                server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                server_socket.bind(("", proxy_port))
-                server_socket.listen(5)
-            except Exception as e:
-                n_tries -= 1
-                server_socket = None
-                logging.warn("%d attempts left: %s" % (n_tries, e))
-                if n_tries > 0:
-                    time.sleep(3)
-                else:
-                    raise
-
-        if gpsd_socket:
-            read_list = [ server_socket, gpsd_socket ]
-        else:
-            read_list = [ server_socket ]
-    except Exception as e:
+        ret = asyncio.run(proxy.run())
+    except OSError as e:
         logging.exception(e)
-        raise
-
-    def term_handler(*unused):
-        global keepGoing
-        logging.info('Received Term.  Closing sockets and exiting')
-        try:
-            keepGoing = 0
-            logging.debug("TERM set keepGoing 0")
-
-        except Exception as e:
-            logging.exception(e)
-    signal.signal(signal.SIGTERM, term_handler)
-
-    messages_archive = {}   # keep track of most recent gpsd message of each type
-    messages_for = {}       # message queues for sockets
-
-    def queue_message_for(sock, msg):
-        logging.debug("Queueing to %s: '%s'" % (sock, msg.strip()))
-        if not sock in messages_for:
-            messages_for[sock] = msg
-        else:
-            messages_for[sock] += msg
-
-    def send_messages_for(sock):
-        ret = 0
-        try:
-            if sock in messages_for:
-                try:
-                    (msg, rest) = messages_for[sock].split("\n", 1)
-                except Exception as e:
-                    # only one left
-                    logging.debug(e)
-                    msg = messages_for[sock]
-                    rest = None
-                if msg != "":
-                    msg += "\n"
-                    logging.debug("--> to %s: %s" % (sock, msg[0:60]))
-                    if sock == gpsd_socket:
-                        ret = gpsd.write(msg)
-                    else:
-                        ret = client_streams[sock].write(msg)
-                        client_streams[sock].flush()
-                if rest:
-                    messages_for[sock] = rest
-                else:
-                    del messages_for[sock]
-            return ret
-        except Exception as e:
-            logging.exception(e)
-            return -1
-    
-    client_sockets = {}
-    client_streams = {}
-
-    last_tpv_send = 0
-
-    next_share_check = 0
-    last_share_compare = None
-
-    # read last loc from current.txt, if not too old
-    fname = "/etc/pwnagotchi/pwn_gpsd/current.txt"
-    if os.path.isfile(fname):
-        mtime = os.stat(fname).st_mtime
-        if (time.time() - mtime) < 60 * 60 * 24:
-            with open(fname, 'r') as f:
-                tpv = f.readlines()
-                logging.warn("Preload location %s" % (tpv))
-                messages_archive['TPV'] = tpv[-1]
-    
-    while keepGoing != 0:
-        if keepGoing > 0:
-            keepGoing -= 1
-
-        if wantPwngrid and not pwngridAdvertising:
-            try:
-                logging.info("Activating pwngrid advertising")
-                pwngrid.advertise(True)
-                pwngridAdvertising = True
-            except Exception as e:
-                logging.error(e)
-                pwngridAdvertising = False
-        try:
-            write_list = messages_for.keys()
-            err_list = read_list.copy()
-            if len(write_list):
-                logging.debug("Write list (%d): %s" % (len(write_list), repr(write_list)))
-            if len(read_list):
-                logging.debug("Read list (%d): %s" % (len(read_list), repr(read_list)))
-            readable, writable, errored = select.select(read_list, write_list, err_list, 1.0)
-            logging.debug("Readable: %s" % repr(readable))
-
-            # look up location from pwngrid peers
-            if useSharedLoc and time.time() > next_share_check:
-                next_share_check = time.time() + 10
-                logging.warning("***\t\t\tChecking peer locs")
-                # get list of peers
-                friend_locs = []
-                try:
-                    peers = pwngrid.peers()
-
-                    for p in peers:
-                        adv = p.get('advertisement', {})
-                        try:
-                            pos = gpsd.decrypt_data(adv.get('snorlax', {}))
-                            if pos:
-                                logging.debug("Peer %s pos: %s" % (adv.get('name', ""), pos))
-                                p_loc = json.loads(pos)
-                                if p_loc:
-                                    logging.debug(p_loc)
-                                    p_loc['name'] = adv['name']
-                                    p_loc['identity'] = adv['identity']
-                                    p_loc['Cached'] = time.time()
-                                    p_loc['rssi'] = p.get('rssi', None)
-                                    friend_locs.append(p_loc)
-                        except Exception as e:
-                            logging.info("Failed %s\n\t%s\n\t%s" % (e, adv.get('name'), adv))
-
-                except Exception as pe:
-                    logging.error("Pwngrid error: %s" % (pe))
-                    pwngridAdvertising = False
-                    
-                # average locations for "my location"
-                if len(friend_locs):
-                    last_tpv = json.loads(messages_archive.get('TPV', "{}"))
-                    new_tpv = copy.deepcopy(friend_locs[0])
-                    new_tpv['name'] = "me"
-                    new_tpv['lat'] = 0
-                    new_tpv['lon'] = 0
-                    new_tpv['alt'] = 0
-                    new_tpv['rssi'] = 0
-                    new_tpv['mode'] = 0
-                    count = 0
-                    altweight = 0
-                    friends = 0
-                    for f in friend_locs:
-                        logging.debug("Friend mode %s" % (f.get('mode')))
-                        if f.get('mode', -2) > new_tpv.get('mode', 0):
-                            new_tpv['mode'] = f.get('mode')
-                            logging.debug("Picking mode from %s" % f)
-                        rssi = f.get('rssi', -198)
-                        mode = f.get('mode', -1)
-                        if f.get('time', '0000-00-00') > new_tpv.get('time', '1111-11-11'):
-                            new_tpv['time'] = f.get('time')
-                        if mode > 1:
-                            weight = int(100+(rssi if rssi > -200 else -198)/2)
-                            new_tpv['lat'] = new_tpv.get('lat', 0) + f.get('lat') * weight
-                            new_tpv['lon'] = new_tpv.get('lon', 0) + f.get('lon') * weight
-                            new_tpv['rssi'] = new_tpv.get('rssi', 0) + rssi * weight
-                            if 'alt' in f:
-                                new_tpv['alt'] = new_tpv.get('alt', 0) + f.get('alt') * weight
-                                altweight += weight
-                            count += weight
-                            friends+=1
-                            logging.debug("Running totals: %s %s", new_tpv['lon'], new_tpv['lat'])
-                    if friends > 0:
-                        if count:
-                            logging.debug("Before Div 2: %s" % (new_tpv['lat']/count))
-                            new_tpv['lat'] /= count
-                            new_tpv['lon'] /= count
-                            new_tpv['rssi'] /= count
-                            if altweight > 0:
-                                new_tpv['alt'] /= altweight
-                            new_tpv['undivided_count'] = (friends,count)
-                            logging.debug("DIVIDED: %d, %d %s" % (friends, count, new_tpv))
-                            logging.info("->Me %s\t%s,%s\t%s\t%s" % (new_tpv['name'], new_tpv['lon'], new_tpv['lat'], new_tpv['rssi'],  new_tpv.get("time", "")))
-
-                        if new_tpv.get('mode', -1) >= last_tpv.get('mode', 0):
-                            # archiving
-                            logging.info("Updating cache from %d friends %s" % (friends, new_tpv))
-                            messages_archive['TPV'] = json.dumps(new_tpv)
-                        if new_tpv.get('mode', -1) >= 2:
-                            if not os.path.isdir("/etc/pwnagotchi/pwn_gpsd"):
-                                os.mkdir("/etc/pwnagotchi/pwn_gpsd")
-                            c_check = "%s %s %s" % (new_tpv.get('time', '00'),
-                                                    new_tpv.get('lat', 69),
-                                                    new_tpv.get('lon', 420))
-                            try:
-                                if last_share_compare != c_check: # do not write the same loc twice
-                                    last_share_compare = c_check
-                                    with open("/etc/pwnagotchi/pwn_gpsd/current.txt", "w") as f:
-                                        logging.debug("CURRENT: %s" % new_tpv)
-                                        f.write(json.dumps(new_tpv))
-                                    now = datetime.now()
-                                    fname = now.strftime("/etc/pwnagotchi/pwn_gpsd/peertrack_%Y%m%d.txt")
-                                    if not os.path.isdir(os.path.dirname(fname)):
-                                        os.mkdir(os.path.dirname(fname))
-                                    with open(fname, "a+") as f:
-                                        f.write(json.dumps(new_tpv) + "\n")
-
-                            except Exception as e:
-                                logging.exception("Logging %s: %s" % (new_tpv, e))
-            else:
-                logging.debug("***\t\t\tNot checking peer locs. too soon")
-
-            for s in readable:
-                if s == server_socket:
-                    # new client connected
-                    client_socket, address = server_socket.accept()
-                    client_sockets[client_socket] = PWN_GPSClient(client_socket, address)
-                    client_streams[client_socket] = client_socket.makefile(mode="rw")
-                    read_list.append(client_socket)
-                    if 'VERSION' in messages_archive:
-                        logging.info("Sending VERSION: %s" % messages_archive['VERSION'])
-                        queue_message_for(client_socket, messages_archive['VERSION']+"\n")
-                elif s == gpsd_socket:
-                    # process from GPSD
-                    try:
-                        raw = gpsd.read()
-                        if raw:
-                            logging.debug("Got %s" % raw.strip())
-                            try:
-                                data = json.loads(raw)
-                                m_class = data.get('class', None)
-                            except Exception as e:
-                                logging.exception("Bad JSON: '%s'\n%s" % (raw, e))
-                            if m_class == 'VERSION':
-                                # newly connected, so start the watch
-                                logging.info("Sending Watch and Devices requests")
-                                queue_message_for(s, '?WATCH={"enable":true, "json":true};\n')
-                                #queue_message_for(s, '?DEVICES;\n')
-                            elif m_class == 'WATCH':
-                                logging.info("WATCH")
-                                for k in data.keys():
-                                    if k == "class":
-                                        continue
-                                    logging.info("\t%s = %s" % (k, data[k]))
-                            elif m_class == 'DEVICE':
-                                logging.debug("GPSD> %s" % raw.strip())
-                                for cl in client_sockets.keys():
-                                    if client_sockets[cl].watch.get('enable', False):
-                                        queue_message_for(cl, raw)
-                            elif m_class == 'DEVICES':
-                                print("GPSD> DEVICES %s" % (data['devices']))
-                            elif m_class == 'TPV': # position update
-                                last_tpv = json.loads(messages_archive.get("LAST_SENT_" + m_class, "{}"))
-                                last_tpv["time"] = data.get("time", "")
-                                if last_tpv == data:
-                                    # same data, so skip it
-                                    logging.debug("Skipping repeat: %s" % (data))
-                                    pass
-                                else:
-                                    mode = data.get('mode', -1)
-                                    if mode == 1:
-                                        logging.debug("Time ept: %s" % (data.get('ept', "--")))
-                                    else:
-                                        logging.debug("Mode %s: %s" % (mode, repr(data)))
-
-                                    logging.debug("PWNgpsd (%d)> %s" % ( time.time() - last_tpv_send, raw.strip()))
-
-                                    propagate = False # do not pass along unless something changed
-                                    if mode > 1:
-                                        if mode == 3 and 'alt' not in data and 'altMSL' not in data:
-                                            if 'alt' in last_tpv:
-                                                # last one had alt, this is mode 3 and should have alt, so
-                                                # skip it and wait for TPV with alt
-                                                logging.debug("Skipping: No altitude, but mode 3: %s" % (data))
-                                                continue
-
-                                        # have some position
-                                        for k,v in {'lat':"%0.5f", 'lon':"%0.5f", 'alt':"%0.0f"}.items():
-                                            #if not propagate and abs(data.get(k, last_tpv.get(k, 0)) - last_tpv.get(k, 0)) > v:
-                                            new = v % float(data.get(k, 0))
-                                            old = v % float(last_tpv.get(k,0))
-                                            if not propagate and (new != old):
-                                                # enough to change the needle and minimal time
-                                                if (time.time()-last_tpv_send > 10):
-                                                    # only log every 10 seconds
-                                                    logging.info("Update for %s (%0.4f) %0.4f, %0.4f, %0.2f" % (k,
-                                                                                                                   last_tpv.get(k, 0),
-                                                                                                                   data.get('lat', 0),
-                                                                                                                   data.get('lon', 0),
-                                                                                                                   data.get('alt', 0)))
-                                                # propagate changes
-                                                propagate = True
-                                                try:
-                                                    if not os.path.isdir("/etc/pwnagotchi/pwn_gpsd"):
-                                                        os.mkdir("/etc/pwnagotchi/pwn_gpsd")
-                                                    with open("/etc/pwnagotchi/pwn_gpsd/current.txt", "w") as f:
-                                                        f.write(raw)
-                                                    now = datetime.now()
-                                                    fname = now.strftime("/etc/pwnagotchi/pwn_gpsd/pwntrack_%Y%m%d.txt")
-                                                    if not os.path.isdir(os.path.dirname(fname)):
-                                                        os.mkdir(os.path.dirname(fname))
-                                                    with open(fname, "a+") as f:
-                                                        f.write(raw.strip() + ",\n")
-                                                except Exception as e:
-                                                    logging.exception("Saving current location: %s" % e)
-
-                                    if not propagate and (time.time()-last_tpv_send > 60):
-                                        # minimum update interval
-                                        logging.info("Min time update %s (%0.4f) %0.4f, %0.4f, %0.2f" % (k,
-                                                                                                    last_tpv.get(k, 0),
-                                                                                                    data.get('lat', 0),
-                                                                                                    data.get('lon', 0),
-                                                                                                    data.get('alt', 0)))
-                                        propagate = True
-
-                                    if propagate:
-                                        last_tpv_send = time.time()
-                                        last = json.loads(messages_archive.get(m_class, "{}"))
-                                        messages_archive["LAST_SENT_%s" % m_class] = raw
-                                            
-                                        # share with proxy clients
-                                        for cl in client_sockets.keys():
-                                            if client_sockets[cl].watch.get('enable', False):
-                                                if last.get('identity'):
-                                                    queue_message_for(cl, json.dumps(last))
-                                                else:
-                                                    queue_message_for(cl, raw)
-                                        # update peering information
-                                        if shareWPeers:
-                                            advert = pwngrid.get_advertisement_data()
-                                            advert['snorlax'] = gpsd.encrypt_data(raw)
-                                            try:
-                                                pwngrid.set_advertisement_data(advert)
-                                            except Exception as e:
-                                                logging.exception(e)
-                                                pwngridAdvertising = False
-                                        
-                            elif m_class == 'PPS': # pps time
-                                pass
-                            elif m_class == 'SKY': # sats
-                                nsats = data.get('nSat', 0)
-                                for sat in data.get('satellites', []):
-                                    logging.debug ("\t%s\t%0.0f\t%0.0f\t%s" % (sat.get('PRN', 0),
-                                                                       sat.get('el', 0),
-                                                                       sat.get('az', 0),
-                                                                       "+" if sat.get('used', False) else ""))
-                                # don't send every time
-                                if random.random() > 0.75:
-                                    logging.debug ("%d satellites visible:" % nsats)
-                                    for cl in client_sockets.keys():
-                                        if client_sockets[cl].watch.get('enable', False):
-                                            queue_message_for(cl, raw)
-                            else:
-                                logging.info("Unknown message type: %s" % raw.strip())
-                            # store latest message of each type
-                            #raw['PWNCached'] = time.time()    # mark when cached
-                            if m_class == 'TPV':
-                                last = json.loads(messages_archive.get(m_class, "{}"))
-                                if last.get('XXXidentity'):
-                                    logging.debug("Keeping remote loc")
-                                else:
-                                    if data.get('mode',0) >= last.get('mode',0) and raw != messages_archive.get(m_class, ""):
-                                        logging.debug("updating %s location %s - %s" % (m_class, raw.strip(), last))
-                                        messages_archive[m_class] = raw
-                            else:
-                                messages_archive[m_class] = raw
-                        else:
-                            logging.info("gpsd returns nothing.  restarting")
-                            sys.exit(3)
-                    except Exception as e:
-                        logging.exception(e)
-                        sys.exit(4)
-                else:
-                    # process input from client
-                    try:
-                        logging.debug("process from client")
-                        try:
-                            raw = client_sockets[s].read()
-                        except (ConnectionResetError, ConnectionAbortedError):
-                            raw = ""
-
-                        if raw == "":
-                            logging.warn("Closing client %s" % (s))
-                            s.close()
-                            if s in client_sockets:
-                                del client_sockets[s]
-                            if s in messages_for:
-                                del messages_for[s]
-                            read_list.remove(s)
-                        elif raw.startswith("?"):
-                            logging.debug("Got %s from %s" % (raw.strip(), s))
-                            if '=' in raw[1:]:
-                                (cmd, data) = raw[1:].strip().split('=',1)
-                            else:
-                               (cmd, ignore) = raw[1:].strip().split(';',1)
-                               data = "{}"
-                            logging.debug("Client command: %s" % cmd)
-                            if cmd == "WATCH":
-                                try:
-                                    jdata = json.loads(data.strip().strip(';'))
-                                    if jdata.get("enable", False):
-                                        logging.info("        Client %s Watch: %s\n\n" % (s, json.dumps(jdata, indent=3)))
-                                        client_sockets[s].watch = jdata
-                                        for upd in [ "TPV", "SKY" ]:
-                                            if upd in messages_archive:
-                                                logging.info("Sending %s to %s" % (upd, s))
-                                                queue_message_for(s, messages_archive[upd])
-                                    else:
-                                        client_sockets[s].watch = {}
-                                except Exception as e:
-                                    logging.exception("JDATA: %s" % e)
-                            elif cmd == "DEVICES":
-                              try:
-                                  if 'DEVICES' in messages_archive:
-                                      logging.info("Sending DEVICES %s" % (s))
-                                      queue_message_for(s, messages_archive['DEVICES'])
-                              except Exception as e:
-                                  logging.exception(e)
-                                  
-                            elif cmd == "POLL":
-                              try:
-                                  jdata = {'class':"POLL",
-                                           'time': datetime.now().strftime("%Y-%m-%dT%H:%m:%sZ"),
-                                           'active': 1,
-                                           }
-                                  logging.debug("POLL Archive contains: %s" % ",".join(messages_archive.keys()))
-                                  if "TPV" in messages_archive:
-                                      jdata['tpv'] = [json.loads(messages_archive['TPV'])]
-                                  if "SKY" in messages_archive:
-                                      jdata['sky'] = [json.loads(messages_archive['SKY'])]
-                                  else:
-                                      pass
-                                  out = json.dumps(jdata)
-                                  logging.debug("Sending to %s: '%s'" % (s, out))
-                                  queue_message_for(s, out)
-                              except Exception as e:
-                                  logging.exception(e)
-                                  
-                            else:
-                                logging.info("CMD %s: %s" % (cmd, data))
-                                if gpsd_socket:
-                                    queue_message_for(gpsd_socket, raw)
-                    except (ConnectionResetError, ConnectionAbortedError):
-                        print("Connection closed by server")
-                        sys.exit(5)
-                    except Exception as e:
-                        logging.exception("Closing client %s: %s" % (s,e))
-                        s.close()
-                        if s in client_sockets:
-                            del client_sockets[s]
-                        if s in messages_for:
-                            del messages_for[s]
-                        read_list.remove(s)
-                        
-            for s in writable:
-                try:
-                    ret = send_messages_for(s)
-                    if ret < 0:
-                        logging.info("\n\n\tClosing client %s\n\n" % (s))                        
-                        s.close()
-                        if s == gpsd_socket:
-                            raise
-                        if s in client_sockets:
-                            del client_sockets[s]
-                        if s in messages_for:
-                            del messages_for[s]
-                        if s in read_list:
-                            read_list.remove(s)
-                                
-                except Exception as e:
-                    logging.exception("Writing %s: %s" % (s, e))
-                    s.close()
-                    if s == gpsd_socket:
-                        raise
-                    if s in client_sockets:
-                        del client_sockets[s]
-                    if s in messages_for:
-                        del messages_for[s]
-                    read_list.remove(s)
-
-            for s in errored:
-                try:
-                    if s == gpsd_socket and s != -1:
-                        logging.info("gpsd socket error: exiting")
-                        s.close()
-                        sys.exit(6)
-                except Exception as e:
-                    logging.exception(e)
-                    sys.exit(7)
-        except (ConnectionResetError, ConnectionAbortedError):
-            print("Connection closed by server")
-            sys.exit(8)
-        except Exception as e:
-            logging.exception(e)
-            if 'oo many open files' in e:
-                sys.exit(24)
-
-    logging.info("Exiting")
-    for s in read_list:
-        try:
-            s.close()
-        except Exception as e:
-            logging.exception(e)
-        
+        ret = 24 if e.errno == errno.EMFILE else 1
+    sys.exit(ret)
@@ -0,0 +1,98 @@
+#
+# pwnshare - encrypted location sharing for pwn-gpsd and its plugins
+#
+# pwn-gpsd advertises its location over the pwngrid mesh in the 'snorlax'
+# field: the TPV line as a JSON string, Fernet encrypted with a key made
+# from a shared password. Building a Fernet means hashing the password,
+# and decrypting costs an HMAC and AES pass, so both are done once here:
+# one Fernet per password, and an LRU of ciphertext -> decoded TPV that
+# everything in the process shares. An advertisement that has not changed
+# since the last look is just a dict lookup.
+#
+
+import logging
+import hashlib
+import base64
+import json
+import threading
+import functools
+from collections import OrderedDict
+
+DEFAULT_PASSWORD = "Friendship"
+ADV_FIELD = "snorlax"
+
+@functools.lru_cache(maxsize=None)
+def fernet_for(password):
+    """The Fernet for a sharing password, built once. cryptography is only imported here, when sharing is used"""
+    from cryptography.fernet import Fernet
+    ekey = hashlib.sha256(password.encode()).digest()
+    return Fernet(base64.urlsafe_b64encode(ekey))
+
+def encrypt_location(raw, password=DEFAULT_PASSWORD):
+    """Encrypt a TPV line the way pwn-gpsd advertises it"""
+    return fernet_for(password).encrypt(json.dumps(raw).encode()).decode()
+
+class LocationCache:
+    """LRU of advertisement ciphertext -> decoded TPV dict.
+
+    Tries each password in order. Tokens that do not decrypt, or do not
+    hold a location, are cached as None so they are not retried."""
+
+    def __init__(self, passwords=(DEFAULT_PASSWORD,), size=256):
+        self.passwords = tuple(dict.fromkeys(p for p in passwords if p))
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _decode(self, token):
+        for password in self.passwords:
+            try:
+                text = fernet_for(password).decrypt(token.encode())
+                break
+            except Exception as e:
+                continue
+        else:
+            logging.debug("Unable to decrypt location %s...", token[:16])
+            return None
+
+        try:
+            tpv = json.loads(text)
+            if isinstance(tpv, str):
+                # pwn-gpsd sends the TPV line as a JSON string
+                tpv = json.loads(tpv)
+        except Exception as e:
+            logging.warning("Shared location is not JSON: %s, %s", e, text)
+            return None
+        return tpv if isinstance(tpv, dict) else None
+
+    def decrypt(self, token):
+        """Decrypted TPV dict for an advertisement field, or None. Returns a copy the caller may change"""
+        if not token or not isinstance(token, str):
+            return None
+        with self._lock:
+            if token in self._cache:
+                self._cache.move_to_end(token)
+                self.hits += 1
+                tpv = self._cache[token]
+                return dict(tpv) if tpv is not None else None
+
+        tpv = self._decode(token)
+        with self._lock:
+            self.misses += 1
+            self._cache[token] = tpv
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return dict(tpv) if tpv is not None else None
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def location_cache(passwords=(DEFAULT_PASSWORD,)):
+    """The LocationCache for these passwords, shared by everything in this process"""
+    key = tuple(dict.fromkeys(p for p in passwords if p))
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = LocationCache(key)
+        return _caches[key]
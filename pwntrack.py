@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+#
+# pwntrack - compact binary track logs for pwn-gpsd
+#
+# Text track logs are one gpsd TPV per line with a trailing comma. The binary
+# format keeps just what the maps need in fixed size records, so a day of
+# tracks can be read with numpy.fromfile or mmap instead of parsing JSON.
+#
+#   header (256 bytes):
+#     magic        8s   b"PWNTRK\0\1"
+#     version      H
+#     record size  H
+#     index step   I    seconds covered by each index slot
+#     base time    d    unix time of index slot 0 (first record, floored to the step)
+#     index        48I  first record number at or after each slot, 0xffffffff if none
+#   records (36 bytes each):
+#     time d, lat d, lon d, alt f, speed f, mode b, 3 pad bytes
+#
+# alt and speed are NaN when the TPV did not have them. Records are appended
+# in arrival order, so they are sorted by time unless the clock jumps.
+#
+# Convert existing logs:
+#   pwntrack.py to-binary /etc/pwnagotchi/pwn_gpsd/pwntrack_20240101.txt
+#   pwntrack.py to-text /etc/pwnagotchi/pwn_gpsd/pwntrack_20240101.bin
+#
+
+import logging
+import os
+import sys
+import struct
+import math
+import time
+import calendar
+import json
+from datetime import datetime, timezone
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except Exception as e:
+    json_loads = json.loads
+
+try:
+    import numpy
+except Exception as e:
+    numpy = None
+
+MAGIC = b"PWNTRK\x00\x01"
+VERSION = 1
+HEADER_SIZE = 256
+INDEX_SLOTS = 48
+INDEX_STEP = 3600
+NO_RECORD = 0xffffffff
+
+HEADER = struct.Struct("<8sHHId%dI" % INDEX_SLOTS)
+RECORD = struct.Struct("<dddffb3x")
+
+if numpy is not None:
+    DTYPE = numpy.dtype([('time', '<f8'), ('lat', '<f8'), ('lon', '<f8'),
+                         ('alt', '<f4'), ('speed', '<f4'), ('mode', 'i1'), ('pad', 'V3')])
+else:
+    DTYPE = None
+
+def binary_name(fname):
+    """pwntrack_20240101.txt -> pwntrack_20240101.bin"""
+    return os.path.splitext(fname)[0] + ".bin"
+
+def text_name(fname):
+    return os.path.splitext(fname)[0] + ".txt"
+
+def track_source(fname):
+    """The log to read for a track: the binary one if it is at least as new as the
+    text one, which a text mode proxy may still be appending to, else fname"""
+    bname = binary_name(fname)
+    if bname != fname and os.path.isfile(bname):
+        if not os.path.isfile(fname) or os.stat(bname).st_mtime >= os.stat(fname).st_mtime:
+            return bname
+    return fname
+
+def parse_time(t_str):
+    """gpsd ISO 8601 time to unix time"""
+    if not t_str:
+        return time.time()
+    if isinstance(t_str, (int, float)):
+        return float(t_str)
+    (whole, _, frac) = t_str.rstrip("Z").partition(".")
+    ret = calendar.timegm(time.strptime(whole, "%Y-%m-%dT%H:%M:%S"))
+    return ret + float("0." + frac) if frac else float(ret)
+
+def format_time(t):
+    return datetime.fromtimestamp(t, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z"
+
+def _float(value):
+    """A record field, NaN when the TPV left it out or sent null"""
+    return math.nan if value is None else float(value)
+
+def pack_record(tpv):
+    """Pack a TPV dict into a binary record, or None if it has no position"""
+    if tpv.get('lat') is None or tpv.get('lon') is None:
+        return None
+    alt = tpv.get('alt')
+    return RECORD.pack(parse_time(tpv.get('time')),
+                       float(tpv['lat']), float(tpv['lon']),
+                       _float(alt if alt is not None else tpv.get('altMSL')),
+                       _float(tpv.get('speed')),
+                       int(tpv.get('mode') or 0))
+
+def record_to_tpv(rec):
+    """(time, lat, lon, alt, speed, mode) back to a TPV dict"""
+    (t, lat, lon, alt, speed, mode) = rec[:6]
+    tpv = {'class': 'TPV', 'mode': int(mode), 'time': format_time(t), 'lat': float(lat), 'lon': float(lon)}
+    if not math.isnan(alt):
+        tpv['alt'] = float(alt)
+    if not math.isnan(speed):
+        tpv['speed'] = float(speed)
+    return tpv
+
+class TrackFile:
+    """Appends records to a binary track, keeping the header index up to date.
+
+    Takes TPV dicts through write(), so it can stand in for a text log file."""
+
+    def __init__(self, path):
+        self.name = path
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = os.fstat(self.fd).st_size
+        if size < HEADER_SIZE:
+            self.base_time = 0
+            self.index = [NO_RECORD] * INDEX_SLOTS
+            self.count = 0
+            self._write_header()
+        else:
+            (self.base_time, self.index) = read_header(os.pread(self.fd, HEADER_SIZE, 0), path)
+            # drop a partial record left by a crash
+            self.count = (size - HEADER_SIZE) // RECORD.size
+        self.pending = []
+        self.dirty = False
+
+    def _write_header(self):
+        header = HEADER.pack(MAGIC, VERSION, RECORD.size, INDEX_STEP, self.base_time, *self.index)
+        os.pwrite(self.fd, header.ljust(HEADER_SIZE, b"\0"), 0)
+
+    def write(self, tpv):
+        rec = pack_record(tpv)
+        return self.append(rec) if rec else 0
+
+    def append(self, rec):
+        """Add a record packed with pack_record"""
+        t = RECORD.unpack_from(rec)[0]
+        if not self.base_time:
+            self.base_time = t - t % INDEX_STEP
+        slot = int((t - self.base_time) // INDEX_STEP)
+        if 0 <= slot < INDEX_SLOTS and self.index[slot] == NO_RECORD:
+            self.index[slot] = self.count + len(self.pending)
+            self.dirty = True
+        self.pending.append(rec)
+        return len(rec)
+
+    def flush(self):
+        if self.pending:
+            os.pwrite(self.fd, b"".join(self.pending), HEADER_SIZE + self.count * RECORD.size)
+            self.count += len(self.pending)
+            self.pending = []
+        if self.dirty:
+            self._write_header()
+            self.dirty = False
+
+    def fileno(self):
+        return self.fd
+
+    def close(self):
+        if self.fd is not None:
+            self.flush()
+            os.close(self.fd)
+            self.fd = None
+
+def read_header(data, fname=""):
+    if len(data) < HEADER.size or data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a pwntrack binary file: %s" % fname)
+    fields = HEADER.unpack_from(data)
+    (magic, version, rec_size, step, base_time) = fields[:5]
+    if rec_size != RECORD.size or step != INDEX_STEP:
+        raise ValueError("Unsupported pwntrack layout v%d (%d byte records): %s" % (version, rec_size, fname))
+    return (base_time, list(fields[5:]))
+
+def is_binary(fname):
+    try:
+        with open(fname, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+def read_records(fname, mmap=False):
+    """Load a binary track as a numpy structured array (fields time, lat, lon, alt, speed, mode)"""
+    with open(fname, "rb") as f:
+        read_header(f.read(HEADER_SIZE), fname)
+    count = (os.stat(fname).st_size - HEADER_SIZE) // RECORD.size
+    if count <= 0:
+        return numpy.zeros(0, dtype=DTYPE)
+    if mmap:
+        return numpy.memmap(fname, dtype=DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,))
+    return numpy.fromfile(fname, dtype=DTYPE, count=count, offset=HEADER_SIZE)
+
+def read_between(fname, t0, t1):
+    """Records with t0 <= time < t1, using the header index to touch as little of the file as possible"""
+    with open(fname, "rb") as f:
+        (base_time, index) = read_header(f.read(HEADER_SIZE), fname)
+    recs = read_records(fname, mmap=True)
+    lo, hi = 0, len(recs)
+    if base_time:
+        slot = int((t0 - base_time) // INDEX_STEP)
+        for i in range(min(slot, INDEX_SLOTS - 1), -1, -1):
+            if index[i] != NO_RECORD:
+                lo = index[i]
+                break
+        slot = int(math.ceil((t1 - base_time) / INDEX_STEP))
+        for i in range(max(slot, 0), INDEX_SLOTS):
+            if index[i] != NO_RECORD:
+                hi = index[i]
+                break
+    window = recs[lo:hi]
+    start = numpy.searchsorted(window['time'], t0, side='left')
+    end = numpy.searchsorted(window['time'], t1, side='left')
+    return numpy.array(window[start:end])
+
+def iter_records(fname):
+    """(time, lat, lon, alt, speed, mode) tuples from a binary track, without numpy"""
+    with open(fname, "rb") as f:
+        read_header(f.read(HEADER_SIZE), fname)
+        while True:
+            data = f.read(RECORD.size * 1024)
+            n = len(data) // RECORD.size
+            if not n:
+                break
+            yield from RECORD.iter_unpack(data[:n * RECORD.size])
+
+def iter_text(fname):
+    """TPV dicts from a text track log, skipping lines that do not parse"""
+    with open(fname, "rb") as f:
+        for line in f:
+            line = line.rstrip().rstrip(b",").strip(b"\0")
+            if not line:
+                continue
+            try:
+                yield json_loads(line)
+            except Exception as e:
+                logging.debug("skip line %s: %s", os.path.basename(fname), e)
+
+def iter_packed(fname):
+    """Binary records from a text track log, skipping lines that are not a TPV that packs"""
+    for tpv in iter_text(fname):
+        try:
+            rec = pack_record(tpv) if isinstance(tpv, dict) else None
+        except (struct.error, TypeError, ValueError) as e:
+            logging.debug("skip record %s: %s", os.path.basename(fname), e)
+            continue
+        if rec:
+            yield rec
+
+def load_track(fname):
+    """Read a text or binary track into a numpy structured array"""
+    if is_binary(fname):
+        return read_records(fname)
+    return numpy.frombuffer(b"".join(iter_packed(fname)), dtype=DTYPE)
+
+def text_to_binary(src, dst):
+    """Convert a text log, skipping records that do not pack. dst only appears once it is complete"""
+    tmp = dst + ".tmp"
+    if os.path.exists(tmp):
+        os.unlink(tmp)
+    n = 0
+    out = TrackFile(tmp)
+    try:
+        for rec in iter_packed(src):
+            out.append(rec)
+            n += 1
+        out.close()
+        os.replace(tmp, dst)
+    except BaseException:
+        out.close()
+        os.unlink(tmp)
+        raise
+    return n
+
+def binary_to_text(src, dst):
+    tmp = dst + ".tmp"
+    n = 0
+    try:
+        with open(tmp, "w") as f:
+            for rec in iter_records(src):
+                f.write(json.dumps(record_to_tpv(rec)) + ",\n")
+                n += 1
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return n
+
+def usage():
+    print("pwntrack.py to-binary FILE.txt [OUT.bin]   convert a text track log to binary")
+    print("pwntrack.py to-text FILE.bin [OUT.txt]     convert a binary track log to text")
+    print("pwntrack.py info FILE.bin                  show header and time range")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) < 3:
+        usage()
+        sys.exit(2)
+
+    (cmd, src) = sys.argv[1:3]
+    try:
+        if cmd == "to-binary":
+            dst = sys.argv[3] if len(sys.argv) > 3 else binary_name(src)
+            n = text_to_binary(src, dst)
+            print("%s: %d records, %d -> %d bytes" % (dst, n, os.stat(src).st_size, os.stat(dst).st_size))
+        elif cmd == "to-text":
+            dst = sys.argv[3] if len(sys.argv) > 3 else text_name(src)
+            if os.path.exists(dst) and os.path.samefile(src, dst):
+                raise ValueError("Refusing to overwrite %s" % src)
+            n = binary_to_text(src, dst)
+            print("%s: %d records" % (dst, n))
+        elif cmd == "info":
+            with open(src, "rb") as f:
+                (base_time, index) = read_header(f.read(HEADER_SIZE), src)
+            recs = list(iter_records(src))
+            print("%s: %d records" % (src, len(recs)))
+            if recs:
+                print("  %s - %s" % (format_time(recs[0][0]), format_time(recs[-1][0])))
+            print("  index from %s: %s" % (format_time(base_time) if base_time else "-",
+                                           [i for i in index if i != NO_RECORD]))
+        else:
+            usage()
+            sys.exit(2)
+    except Exception as e:
+        logging.error(e)
+        sys.exit(1)
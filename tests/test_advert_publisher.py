@@ -0,0 +1,73 @@
+#
+# PWN_AdvertPublisher must keep republishing a unit that does not move,
+# or peer_map drops it once its advertisement stops changing.
+#
+# pwn-gpsd.py loads the pwnagotchi plugin modules when imported, so this
+# runs where pwnagotchi is installed:
+#   python3 -m unittest discover tests
+#
+
+import asyncio
+import importlib.util
+import os
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+try:
+    import pwnagotchi.plugins
+except Exception as e:
+    pwnagotchi = None
+
+def load_pwn_gpsd():
+    spec = importlib.util.spec_from_file_location("pwn_gpsd", os.path.join(HERE, "..", "pwn-gpsd.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+@unittest.skipUnless(pwnagotchi, "needs pwnagotchi")
+class TestAdvertPublisher(unittest.TestCase):
+
+    def setUp(self):
+        self.pg = load_pwn_gpsd()
+
+    def run_publisher(self, offers, interval, **settings):
+        """Offer the same parked location offers times, interval seconds apart.
+        Returns the times it was published"""
+        published = []
+        tpv = {'class': 'TPV', 'mode': 3, 'lat': 37.0, 'lon': -122.0}
+        raw = '{"class":"TPV","mode":3,"lat":37.0,"lon":-122.0}'
+
+        async def main():
+            publisher = self.pg.PWN_AdvertPublisher(lambda line: published.append(time.monotonic()), **settings)
+            task = asyncio.create_task(publisher.run())
+            for i in range(offers):
+                publisher.offer(raw, dict(tpv))
+                await asyncio.sleep(interval)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+            return publisher
+        return (published, asyncio.run(main()))
+
+    def test_parked_unit_is_republished(self):
+        (published, publisher) = self.run_publisher(12, 0.1, min_period=0.05, min_distance=10,
+                                                    timeout=1, max_period=0.3)
+        self.assertGreaterEqual(len(published), 3)
+        gaps = [b - a for (a, b) in zip(published, published[1:])]
+        self.assertLess(max(gaps), 0.5)
+
+    def test_republished_without_new_offers(self):
+        # the proxy only offers what it sends on, which may stop altogether when parked
+        (published, publisher) = self.run_publisher(1, 1.0, min_period=0.05, min_distance=10,
+                                                    timeout=1, max_period=0.3)
+        self.assertGreaterEqual(len(published), 3)
+
+    def test_no_max_period_publishes_once(self):
+        (published, publisher) = self.run_publisher(12, 0.1, min_period=0.05, min_distance=10,
+                                                    timeout=1, max_period=0)
+        self.assertEqual(len(published), 1)
+        self.assertGreater(publisher.skipped, 0)
+
+if __name__ == "__main__":
+    unittest.main()